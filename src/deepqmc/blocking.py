@@ -0,0 +1,101 @@
+import numpy as np
+from uncertainties import ufloat
+
+__all__ = ()
+
+
+class BlockingAccumulator:
+    r"""Streaming estimate of a mean and its error from correlated samples.
+
+    Samples are consumed as blocks of per-walker averages. The mean over
+    walkers of each block forms a time series that is reblocked on the fly
+    following Flyvbjerg and Petersen: each reblocking level keeps only
+    a running mean and variance, and an unpaired value waiting for its
+    partner, so the memory scales with the number of walkers and
+    logarithmically with the number of blocks. The error is taken at the
+    optimal reblocking level according to the criterion of Lee et al.,
+    :math:`B^3>2n(\sigma_B/\sigma_0)^4`. Until the series is long enough for
+    any level to satisfy the criterion, the error is estimated from the
+    spread of the walker averages, treating walkers as independent.
+    """
+
+    def __init__(self):
+        self.n_blocks = 0
+        self._walker_sums = None
+        # per level: number of values, mean, sum of squared deviations, and
+        # an unpaired value
+        self._levels = []
+
+    def update(self, xs):
+        r"""Add a block of per-walker averages.
+
+        Args:
+            xs (:class:`numpy.ndarray`:math:`(\cdot)`): block averages
+        """
+        xs = np.asarray(xs, dtype=float)
+        if self._walker_sums is None:
+            self._walker_sums = np.zeros_like(xs)
+        self._walker_sums += xs
+        self.n_blocks += 1
+        x = xs.mean()
+        for level in self._iter_levels():
+            n, mean, m2, unpaired = level
+            n += 1
+            delta = x - mean
+            mean += delta / n
+            m2 += delta * (x - mean)
+            level[:3] = n, mean, m2
+            if unpaired is None:
+                level[3] = x
+                break
+            level[3] = None
+            x = (unpaired + x) / 2
+
+    def _iter_levels(self):
+        i = 0
+        while True:
+            if i == len(self._levels):
+                self._levels.append([0, 0.0, 0.0, None])
+            yield self._levels[i]
+            i += 1
+
+    @property
+    def mean(self):
+        return self._walker_sums.mean() / self.n_blocks
+
+    def reblock(self):
+        """Return standard errors of the mean for all reblocking levels.
+
+        Returns:
+            list of (int, int, float): block length in the units of the
+            original blocks, number of blocks, standard error
+        """
+        return [
+            (2 ** i, n, np.sqrt(m2 / (n - 1) / n))
+            for i, (n, _, m2, _) in enumerate(self._levels)
+            if n > 1
+        ]
+
+    def optimal_level(self):
+        """Return the index of the optimal reblocking level or :data:`None`."""
+        levels = self.reblock()
+        if not levels or levels[0][2] == 0:
+            return None
+        n, err0 = levels[0][1:]
+        for i, (size, _, err) in enumerate(levels):
+            if size ** 3 > 2 * n * (err / err0) ** 4:
+                return i
+        return None
+
+    @property
+    def error(self):
+        level = self.optimal_level()
+        if level is not None:
+            return self.reblock()[level][2]
+        walker_means = self._walker_sums / self.n_blocks
+        return walker_means.std() / np.sqrt(len(walker_means))
+
+    @property
+    def value(self):
+        """Return the mean with its error as :class:`~uncertainties.ufloat`."""
+        return ufloat(self.mean, self.error)
@@ -14,6 +14,7 @@ from .fit import fit_wf
 from .io import wf_from_file
 from .sampling import LangevinSampler, sample_wf
 from .train import train
+from .utils import CheckpointStore
 from .wf import ANSATZES
 
 __all__ = ()
@@ -25,6 +26,7 @@ DEEPQMC_DEFAULTS = {
     (train, 'fit_kwargs'): fit_wf,
     (train, 'optimizer_kwargs'): True,
     (train, 'lr_scheduler_kwargs'): True,
+    (train, 'chkpts_kwargs'): CheckpointStore,
     (LangevinSampler.from_wf, 'kwargs'): LangevinSampler,
     (evaluate, 'sampler_kwargs'): (
         LangevinSampler.from_wf,
@@ -221,8 +223,20 @@ def train_at(workdir, save_every, cuda, max_restarts, hook):
     show_default=True,
     help='Toggle storing of individual sampling steps.',
 )
+@click.option(
+    '--save-every',
+    type=int,
+    help='Frequency in steps of saving the sampling state for resuming.  '
+    '[default: 100]',
+)
+@click.option(
+    '--target-error',
+    type=float,
+    help='Sample until the standard error of the energy reaches this value, '
+    'limited by n_steps only if given in evaluate_kwargs.',
+)
 @click.option('--hook', is_flag=True)
-def evaluate_at(workdir, cuda, store_steps, hook):
+def evaluate_at(workdir, cuda, store_steps, save_every, target_error, hook):
     """Estimate total energy of an ansatz via Monte Carlo sampling.
 
     The calculation details must be specified in a "param.toml" file in WORKDIR,
@@ -236,13 +250,13 @@ def evaluate_at(workdir, cuda, store_steps, hook):
         sys.path.append(str(workdir))
         import dlqmc_hook  # noqa: F401
     wf, params, state = wf_from_file(workdir)
-    if state:
-        wf.load_state_dict(state['wf'])
     if cuda:
         wf.cuda()
-    evaluate(
-        wf,
-        store_steps=store_steps,
-        workdir=workdir,
-        **params.get('evaluate_kwargs', {}),
-    )
+    evaluate_kwargs = params.get('evaluate_kwargs', {})
+    if save_every is not None:
+        evaluate_kwargs['save_every'] = save_every
+    else:
+        evaluate_kwargs.setdefault('save_every', 100)
+    if target_error is not None:
+        evaluate_kwargs['target_error'] = target_error
+    evaluate(wf, store_steps=store_steps, workdir=workdir, **evaluate_kwargs)
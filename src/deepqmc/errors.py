@@ -12,9 +12,10 @@ class DeepQMCError(Exception):
 
 
 class NanError(DeepQMCError):
-    def __init__(self, rs):
+    def __init__(self, rs, mask=None):
         super().__init__()
         self.rs = rs
+        self.mask = mask
 
 
 class TrainingBlowup(DeepQMCError):
@@ -1,27 +1,48 @@
+import hashlib
+import io
+import logging
+import math
+import queue
+import time
+import traceback
+from collections import deque
 from itertools import count
 from pathlib import Path
 
 import h5py
 import numpy as np
+import torch
+import torch.multiprocessing as mp
 from torch.utils.tensorboard import SummaryWriter
 from tqdm.auto import tqdm
-from uncertainties import unumpy as unp
 
+from .blocking import BlockingAccumulator
+from .errors import DeepQMCError
+from .observables import observables_plugin
+from .plugins import PLUGINS
 from .sampling import LangevinSampler, sample_wf
-from .utils import H5LogTable
+from .torchext import is_cuda
+from .utils import H5LogTable, atomic_save, cpu_snapshot
 
 __version__ = '0.1.0'
 __all__ = ['evaluate']
 
+log = logging.getLogger(__name__)
 
-def evaluate(
+
+def evaluate(  # noqa: C901
     wf,
     store_steps=False,
     workdir=None,
     log_dict=None,
+    state=None,
+    save_every=None,
+    observables=None,
     *,
-    n_steps=500,
+    n_steps=None,
     sample_size=1_000,
+    n_workers=1,
+    target_error=None,
     sample_kwargs=None,
     sampler_kwargs=None,
 ):
@@ -31,13 +52,46 @@ def evaluate(
     function model. It initializes a :class:`~deepqmc.sampling.LangevinSampler`,
     sets up a Tensorboard writer, and calls :func:`~deepqmc.sampling.sample_wf`.
 
+    If *target_error* is given, sampling continues until the standard error of
+    the energy, estimated by reblocking, reaches the target. The remaining time
+    is then projected from the current error and sampling rate, assuming the
+    error decreases as the inverse square root of the number of steps. The
+    evaluation can be interrupted with :class:`KeyboardInterrupt`, in which
+    case the current estimate is returned.
+
+    With *n_workers* larger than one, the walkers are split between independent
+    worker processes with their own random seeds, which share the wave function
+    parameters. The blocks from all workers are merged in the main process into
+    a single estimate, as if sampled with a single sampler. Individual steps
+    cannot be stored in this mode.
+
+    With *workdir*, the sampling state is stored in ``evaluate.pt`` on exit and
+    every *save_every* steps, and a later evaluation in the same *workdir*
+    resumes from it, appending to the existing HDF5 file. The stored state
+    includes a fingerprint of the wave function parameters, and resuming with
+    different parameters raises :class:`~deepqmc.errors.DeepQMCError`.
+
+    The *observables* are accumulated during sampling without storing the
+    individual samples, and their results are stored in the HDF5 file under
+    ``observables``.
+
     Args:
         wf (:class:`~deepqmc.wf.WaveFunction`): wave function model to be evaluated
         store_steps (bool): whether to store individual sampled electron configuraitons
         workdir (str): path where to store Tensorboard event file and HDF5 file with
             sampling block energies
-        n_steps (int): number of sampling steps
+        state (dict): if given, the sampling state is stored in it on exit, and
+            if not empty, sampling resumes from the stored state
+        save_every (int): number of steps between storing the sampling state
+            in *workdir*
+        observables (list): :class:`~deepqmc.observables.Observable` instances
+            accumulated during sampling
+        n_steps (int): number of sampling steps, maximum number if *target_error*
+            is given, defaults to 500 steps without *target_error* and to no
+            limit with it
         sample_size (int): number of Markov-chain walkers
+        n_workers (int): number of worker processes for parallel sampling on CPU
+        target_error (float): requested standard error of the energy
         n_decorrelate (int): number of extra steps between samples included
             in the expectation value averaging
         sampler_kwargs (dict): extra arguments passed to
@@ -48,56 +102,358 @@ def evaluate(
     Returns:
         dict: Expectation values with standard errors.
     """
+    if n_steps is None:
+        n_steps = math.inf if target_error else 500
+    fingerprint = _fingerprint(wf)
     if workdir:
         workdir = Path(workdir)
+        state_file = workdir / 'evaluate.pt'
+        if not state and state_file.exists():
+            state = {} if state is None else state
+            state.update(torch.load(state_file))
+    if state and state.get('fingerprint') != fingerprint:
+        raise DeepQMCError(
+            'Cannot resume evaluation of a different wave function, '
+            + (
+                f'remove {state_file} and the sampled data to start afresh'
+                if workdir
+                else 'pass an empty state to start afresh'
+            )
+        )
+    if state and state['step'] >= n_steps:
+        log.info(f'Evaluation already finished after {state["step"]} steps')
+        return {'energy': state['accumulator'].value}
+    if workdir:
         writer = SummaryWriter(log_dir=workdir, flush_secs=15)
         h5file = h5py.File(workdir / 'sample.h5', 'a', libver='v110')
         h5file.swmr_mode = True
         table_blocks = H5LogTable(h5file.require_group('blocks'))
         table_steps = H5LogTable(h5file.require_group('steps'))
+        if state:
+            # rows written after the stored state are discarded
+            n_blocks, n_steps_stored = state['table_sizes']
+            table_blocks.resize(min(n_blocks, len(table_blocks['energy'])))
+            table_steps.resize(min(n_steps_stored, len(table_steps['E_loc'])))
     else:
         writer = None
-    sampler = LangevinSampler.from_wf(
-        wf,
-        sample_size=sample_size,
-        writer=writer,
-        n_discard=0,
-        **{'n_decorrelate': 4, **(sampler_kwargs or {})},
-    )
+    sampler_kwargs = {'n_decorrelate': 4, **(sampler_kwargs or {})}
+    sample_kwargs = sample_kwargs or {}
+    if state:
+        log.info(f'Resuming evaluation after {state["step"]} steps')
+        accumulator = state['accumulator']
+        init_step = state['step']
+        sample_kwargs = {**sample_kwargs, 'equilibrate': False}
+    else:
+        accumulator = BlockingAccumulator()
+        init_step = 0
     steps = tqdm(count(), desc='equilibrating', disable=None)
-    blocks = []
-    try:
-        for step, energy in sample_wf(
+    blocks = deque()
+    if n_workers > 1:
+        if store_steps or log_dict is not None:
+            raise DeepQMCError('Individual steps are not stored in parallel mode')
+        if observables:
+            raise DeepQMCError('Observables are not accumulated in parallel mode')
+        sampler = None
+        sampler_states = state['sampler'] if state else n_workers * [None]
+        if len(sampler_states) != n_workers:
+            raise DeepQMCError(
+                f'Cannot resume evaluation with {len(sampler_states)} workers '
+                f'using {n_workers} workers'
+            )
+        sampling = sample_wf_parallel(
+            wf,
+            n_workers,
+            sampler_states,
+            steps,
+            blocks=blocks if workdir else None,
+            accumulator=accumulator,
+            sample_size=sample_size,
+            save_every=save_every,
+            sampler_kwargs=sampler_kwargs,
+            sample_kwargs=sample_kwargs,
+        )
+    else:
+        sampler = LangevinSampler.from_wf(
+            wf, sample_size=sample_size, writer=writer, n_discard=0, **sampler_kwargs
+        )
+        if state:
+            sampler.load_state_dict(state['sampler'])
+            obs_states = state.get('observables', [])
+            for observable, obs_state in zip(observables or (), obs_states):
+                observable.load_state_dict(obs_state)
+        if observables:
+            sample_plugin = sample_kwargs.get('sample_plugin')
+            sample_kwargs = {
+                **sample_kwargs,
+                'sample_plugin': observables_plugin(
+                    observables, sample_plugin or PLUGINS.get('sample_plugin')
+                ),
+            }
+        sampling = sample_wf(
             wf,
             sampler.iter_with_info(),
             steps,
-            blocks=blocks,
+            blocks=blocks if workdir else None,
+            accumulator=accumulator,
             log_dict=log_dict
             if log_dict is not None
             else table_steps.row
             if workdir and store_steps
             else None,
             writer=writer,
-            **(sample_kwargs or {}),
-        ):
+            **sample_kwargs,
+        )
+    energy = accumulator.value if accumulator.n_blocks else None
+    eval_step = block_step = last_save = init_step
+    n_blocks_done = accumulator.n_blocks
+    equilibrated = False
+    table_sizes = state['table_sizes'] if state else (0, 0)
+    obs_states = [obs.state_dict() for obs in observables or ()]
+
+    def current_state():
+        # the state corresponds to the last full block, samples from the
+        # incomplete block are discarded
+        return {
+            'fingerprint': fingerprint,
+            'step': block_step,
+            'sampler': sampler.state_dict() if sampler else list(sampler_states),
+            'accumulator': accumulator,
+            'table_sizes': table_sizes,
+            'observables': obs_states,
+        }
+
+    try:
+        for step, energy in sampling:
             if energy == 'eq':
-                steps.total = step + n_steps
+                equilibrated = True
+                eq_step = step
+                if n_steps < math.inf:
+                    steps.total = step + n_steps - init_step
                 steps.set_description('evaluating')
+                start = time.time()
                 continue
-            if energy is not None:
-                steps.set_postfix(E=f'{energy:S}')
+            eval_step = init_step + step - eq_step + 1
+            block_done = accumulator.n_blocks > n_blocks_done
+            if block_done:
+                n_blocks_done = accumulator.n_blocks
+                block_step = eval_step
+                obs_states = [obs.state_dict() for obs in observables or ()]
             if workdir:
-                if len(blocks) > len(table_blocks['energy']):
-                    block = blocks[-1]
-                    table_blocks.row['energy'] = np.stack(
-                        [unp.nominal_values(block), unp.std_devs(block)], -1
+                while blocks:
+                    table_blocks.row['energy'] = blocks.popleft()
+                if block_done:
+                    table_sizes = (
+                        len(table_blocks['energy']),
+                        len(table_steps['E_loc']),
+                    )
+                save = (
+                    block_done and save_every and block_step - last_save >= save_every
+                )
+                table_blocks.flush(force=save)
+                table_steps.flush(force=save)
+                if save:
+                    atomic_save(cpu_snapshot(current_state()), state_file)
+                    last_save = block_step
+            if energy is not None:
+                postfix = {'E': f'{energy:S}'}
+                if target_error and accumulator.optimal_level() is not None:
+                    if energy.std_dev <= target_error:
+                        log.info(f'Reached target error after {eval_step} steps')
+                        break
+                    # the error decreases as the inverse square root of the
+                    # number of steps, the error covers all steps including
+                    # those of a resumed evaluation, whereas the sampling rate
+                    # is measured only in this run
+                    remaining = eval_step * ((energy.std_dev / target_error) ** 2 - 1)
+                    eta = (time.time() - start) / (eval_step - init_step) * remaining
+                    postfix['ETA'] = tqdm.format_interval(eta)
+                steps.set_postfix(postfix)
+            if eval_step >= n_steps:
+                if target_error:
+                    error = (
+                        f', error {energy.std_dev:.2g}' if energy is not None else ''
+                    )
+                    log.warning(
+                        f'Stopped after {eval_step} steps before reaching '
+                        f'the target error {target_error:.2g}{error}'
                     )
-                h5file.flush()
-            if step >= (steps.total or n_steps) - 1:
                 break
+    except KeyboardInterrupt:
+        log.warning(f'Evaluation interrupted after {eval_step} steps')
     finally:
+        sampling.close()
         steps.close()
+        if state is not None and equilibrated:
+            state.update(current_state())
         if workdir:
             writer.close()
+            table_blocks.flush(force=True)
+            table_steps.flush(force=True)
+            if observables:
+                group = h5file.require_group('observables')
+                for observable in observables:
+                    observable.to_h5(group)
             h5file.close()
+            if equilibrated:
+                atomic_save(cpu_snapshot(current_state()), state_file)
     return {'energy': energy}
+
+
+def _fingerprint(wf):
+    # hash of the parameters and buffers identifying the evaluated wave function
+    sha = hashlib.sha1()
+    for name, tensor in wf.state_dict().items():
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def sample_wf_parallel(  # noqa: C901
+    wf,
+    n_workers,
+    sampler_states,
+    steps,
+    blocks=None,
+    accumulator=None,
+    *,
+    sample_size,
+    save_every,
+    sampler_kwargs,
+    sample_kwargs,
+):
+    # Mimics sample_wf() with walkers split between spawned worker processes.
+    # Workers send their blocks, which are merged once available from all
+    # workers. Sampler states sent by workers are stored in sampler_states.
+    if is_cuda(wf):
+        raise DeepQMCError('Parallel evaluation is implemented only on CPU')
+    wf.share_memory()
+    ctx = mp.get_context('spawn')
+    messages = ctx.Queue(maxsize=4 * n_workers)
+    stop = ctx.Event()
+    seeds = torch.randint(2 ** 31, (n_workers,)).tolist()
+    n_threads = max(1, torch.get_num_threads() // n_workers)
+    sizes = [len(idxs) for idxs in np.array_split(range(sample_size), n_workers)]
+    workers = [
+        ctx.Process(
+            target=_sample_wf_worker,
+            args=(rank, wf, messages, stop, seeds[rank], n_threads),
+            kwargs={
+                'sample_size': sizes[rank],
+                'sampler_state': sampler_states[rank],
+                'save_every': save_every,
+                'sampler_kwargs': sampler_kwargs,
+                'sample_kwargs': sample_kwargs,
+            },
+            daemon=True,
+        )
+        for rank in range(n_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    steps = iter(steps)
+    step = next(steps)
+    n_eq, n_done = 0, 0
+    n_steps = np.zeros(n_workers, dtype=int)
+    pending = [deque() for _ in range(n_workers)]
+    accumulator = accumulator if accumulator is not None else BlockingAccumulator()
+    energy = accumulator.value if accumulator.n_blocks else None
+    try:
+        while True:
+            kind, rank, *payload = messages.get()
+            if kind == 'error':
+                n_done += 1
+                raise DeepQMCError(f'Evaluation worker {rank} failed:\n{payload[0]}')
+            if kind == 'state':
+                sampler_states[rank] = torch.load(io.BytesIO(payload[0]))
+            elif kind == 'eq':
+                n_eq += 1
+                if n_eq == n_workers:
+                    yield step, 'eq'
+            elif kind == 'step':
+                if payload[0] is not None:
+                    pending[rank].append(payload[0])
+                n_step_merged = n_steps.min()
+                n_steps[rank] += 1
+                if n_steps.min() == n_step_merged:
+                    continue
+                if all(pending):
+                    block = np.concatenate([p.popleft() for p in pending])
+                    if blocks is not None:
+                        blocks.append(block)
+                    accumulator.update(block[:, 0])
+                    energy = accumulator.value
+                if n_step_merged > 0:
+                    step = next(steps)
+                yield step, energy
+    finally:
+        stop.set()
+        # workers send their final states before finishing
+        while n_done < n_workers:
+            try:
+                kind, rank, *payload = messages.get(timeout=1)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break
+                continue
+            if kind == 'state':
+                sampler_states[rank] = torch.load(io.BytesIO(payload[0]))
+            elif kind in {'done', 'error'}:
+                n_done += 1
+        for worker in workers:
+            worker.join()
+
+
+def _sample_wf_worker(
+    rank,
+    wf,
+    messages,
+    stop,
+    seed,
+    n_threads,
+    *,
+    sample_size,
+    sampler_state,
+    save_every,
+    sampler_kwargs,
+    sample_kwargs,
+):
+    torch.manual_seed(seed)
+    torch.set_num_threads(n_threads)
+    try:
+        sampler = LangevinSampler.from_wf(
+            wf, sample_size=sample_size, n_discard=0, **sampler_kwargs
+        )
+        if sampler_state:
+            sampler.load_state_dict(sampler_state)
+            sample_kwargs = {**sample_kwargs, 'equilibrate': False}
+        blocks = deque()
+        eval_step = last_save = 0
+        for _, energy in sample_wf(
+            wf, sampler.iter_with_info(), count(), blocks=blocks, **sample_kwargs
+        ):
+            if stop.is_set():
+                break
+            if energy == 'eq':
+                messages.put(('eq', rank))
+                continue
+            eval_step += 1
+            block = blocks.popleft() if blocks else None
+            messages.put(('step', rank, block))
+            if block is not None and save_every and eval_step - last_save >= save_every:
+                messages.put(('state', rank, _serialize(sampler.state_dict())))
+                last_save = eval_step
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        messages.put(('error', rank, traceback.format_exc()))
+        return
+    messages.put(('state', rank, _serialize(sampler.state_dict())))
+    messages.put(('done', rank))
+
+
+def _serialize(obj):
+    # tensors put to a queue are shared via file descriptors, which become
+    # invalid once the worker exits, so states are sent as bytes instead
+    buffer = io.BytesIO()
+    torch.save(obj, buffer)
+    return buffer.getvalue()
@@ -76,15 +76,25 @@ class EWMMonitor(EWMAverage):
         self._PERCENTILES = 100 * (1 + np.array(percentiles)) / 2
 
     def mean_of(self, label):
+        if not self.step:
+            return ufloat(np.nan, np.nan)
         i = self.I[label]
         return ufloat(self._mean[i], np.sqrt(self._sqerr[i]))
 
     def update(self, x):
         I = self.I
+        x = x[~np.isnan(x)]
         stat = np.empty(len(self.I))
         a = np.empty_like(stat)
-        stat[: len(self._PERCENTILES)] = np.percentile(x, self._PERCENTILES)
-        stat[I['mean'] :] = x.mean()
+        if len(x):
+            stat[: len(self._PERCENTILES)] = np.percentile(x, self._PERCENTILES)
+            stat[I['mean'] :] = x.mean()
+        else:
+            # all values are nan, the averages are kept but the step advances,
+            # unless there is nothing to initialize the averages from
+            stat[:] = np.nan
+            if not self.step:
+                return np.zeros(len(stat), dtype=bool), stat
         alpha = self._alpha(self.step)
         a[: I['mean_slow']] = min(0.96, alpha)
         a[I['mean_slow']] = min(0.999, alpha)
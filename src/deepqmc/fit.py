@@ -68,6 +68,14 @@ def log_clipped_outliers(x, q):
     return median + x
 
 
+def nan_padded(x, mask):
+    if mask.all():
+        return x
+    padded = x.new_full(mask.shape, float('nan'))
+    padded[mask] = x
+    return padded
+
+
 def fit_wf(  # noqa: C901
     wf,
     loss_func,
@@ -80,10 +88,12 @@ def fit_wf(  # noqa: C901
     require_psi_gradient=True,
     subbatch_size=None,
     max_memory=None,
+    quarantine=None,
     *,
     clip_outliers=True,
     q=5,
     max_grad_norm=None,
+    max_nan_fraction=0.01,
     kfac=None,
 ):
     r"""Fit a wave function using the variational principle and gradient descent.
@@ -117,10 +127,15 @@ def fit_wf(  # noqa: C901
             considered if automatically estimating the subbatch_size. If :data:`None`
             and subbatch_size is estimated, the maximum memory is set to the total
             free GPU memory. When training on CPU always set to :data:`None`.
+        quarantine (callable): called with the coordinates of samples excluded
+            from a step because of nan values, e.g. to store them for debugging
         clip_outliers (bool): whether to clip local energy outliers
         q (float): multiple of MAE defining outliers
         max_grad_norm (float): maximum gradient norm passed to
             :func:`torch.nn.utils.clip_grad_norm_`
+        max_nan_fraction (float): maximum fraction of samples in a batch with nan
+            local energies that are excluded from the step before
+            :class:`~deepqmc.errors.NanError` is raised
     """
     if not is_cuda(wf) and max_memory:
         raise DeepQMCError(
@@ -138,17 +153,34 @@ def fit_wf(  # noqa: C901
         rs_batch = rs
         opt.zero_grad()
         subbatch_size = subbatch_size or len(rs)
-        subbatches = []
+        subbatches, healthy = [], []
         for rs, log_psi0s, _ in DataLoader(
             TensorDataset(rs, log_psi0s, sign_psi0s), batch_size=subbatch_size
         ):
             with kfac.track_forward() if kfac else nullcontext():
-                Es_loc, log_psis, sign_psis = local_energy(
-                    rs,
-                    wf.sample(False),
-                    create_graph=require_energy_gradient,
-                    keep_graph=require_psi_gradient,
-                )
+                try:
+                    Es_loc, log_psis, sign_psis = local_energy(
+                        rs,
+                        wf.sample(False),
+                        create_graph=require_energy_gradient,
+                        keep_graph=require_psi_gradient,
+                    )
+                    healthy.append(torch.ones_like(log_psi0s, dtype=torch.bool))
+                except NanError as e:
+                    n_nan = sum((~mask).sum() for mask in healthy) + e.mask.sum()
+                    if n_nan > max_nan_fraction * len(rs_batch):
+                        raise NanError(rs_batch) from e
+                    log.warning(f'Excluding {e.mask.sum()} samples with nan values')
+                    if quarantine:
+                        quarantine(rs[e.mask])
+                    healthy.append(~e.mask)
+                    rs, log_psi0s = rs[~e.mask], log_psi0s[~e.mask]
+                    Es_loc, log_psis, sign_psis = local_energy(
+                        rs,
+                        wf,
+                        create_graph=require_energy_gradient,
+                        keep_graph=require_psi_gradient,
+                    )
             log_ws = 2 * log_psis.detach() - 2 * log_psi0s
             Es_loc_loss = log_clipped_outliers(Es_loc, q) if clip_outliers else Es_loc
             loss = loss_func(Es_loc_loss, log_psis, normalize_mean(log_ws.exp()))
@@ -170,6 +202,7 @@ def fit_wf(  # noqa: C901
         loss, Es_loc, Es_loc_loss, log_psis, sign_psis, log_ws = (
             torch.cat(xs) for xs in zip(*subbatches)
         )
+        healthy = torch.cat(healthy)
         if torch.isnan(loss).any():
             raise NanError(rs_batch)
         if any(
@@ -203,12 +236,14 @@ def fit_wf(  # noqa: C901
                 writer.add_scalar(f'param/{label}', value, step)
             writer.add_scalar('misc/learning_rate', lr, step)
             writer.add_scalar('misc/batch_size', len(Es_loc), step)
+            writer.add_scalar('misc/quarantined', (~healthy).sum(), step)
         if log_dict is not None:
-            log_dict['E_loc'] = Es_loc.cpu().numpy()
-            log_dict['E_loc_loss'] = Es_loc_loss.cpu().numpy()
-            log_dict['log_psis'] = log_psis.cpu().numpy()
-            log_dict['sign_psis'] = sign_psis.cpu().numpy()
-            log_dict['log_ws'] = log_ws.cpu().numpy()
+            # excluded samples are logged as nans to keep a fixed batch size
+            log_dict['E_loc'] = nan_padded(Es_loc, healthy).cpu().numpy()
+            log_dict['E_loc_loss'] = nan_padded(Es_loc_loss, healthy).cpu().numpy()
+            log_dict['log_psis'] = nan_padded(log_psis, healthy).cpu().numpy()
+            log_dict['sign_psis'] = nan_padded(sign_psis, healthy).cpu().numpy()
+            log_dict['log_ws'] = nan_padded(log_ws, healthy).cpu().numpy()
             log_dict['learning_rate'] = lr
         if kfac:
             kfac.step_precondition()
@@ -56,4 +56,7 @@ def wf_from_file(workdir):
         assert 'workdir' not in kwargs
         kwargs['workdir'] = workdir
     wf = ansatz.entry(mol, **kwargs)
+    if state:
+        # the model is adjusted to the stored state, such as when pruned
+        wf.load_state_dict(state['wf'])
     return wf, params, state
@@ -0,0 +1,240 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+import torch
+
+from .physics import pairwise_distance, pairwise_self_distance
+
+__version__ = '0.1.0'
+__all__ = [
+    'Observable',
+    'RadialDensity',
+    'DensityGrid',
+    'PairDistances',
+    'observables_plugin',
+]
+
+
+def observables_plugin(observables, sample_plugin=None):
+    """Return a sample plugin that updates observables.
+
+    The returned callable can be passed as *sample_plugin* to
+    :func:`~deepqmc.sampling.sample_wf`, or stored in
+    ``PLUGINS['sample_plugin']``.
+
+    Args:
+        observables (list): :class:`Observable` instances updated with the
+            samples and their walker weights
+        sample_plugin (callable): another sample plugin called afterwards
+    """
+
+    def plugin(wf, rs, log_dict):
+        weights = log_dict.get('weights')
+        if weights is not None:
+            weights = torch.from_numpy(weights).to(rs)
+        with torch.no_grad():
+            for observable in observables:
+                observable.update(rs, weights)
+        if sample_plugin:
+            sample_plugin(wf, rs, log_dict)
+
+    return plugin
+
+
+class Observable(ABC):
+    r"""Base class for observables accumulated from samples during sampling.
+
+    An observable is updated with every batch of sampled electron coordinates
+    by a sample plugin, see :func:`observables_plugin`, and stores only a
+    fixed-size summary of the samples, such as a histogram. Derived classes
+    implement :meth:`update` and :meth:`result`, and list their accumulated
+    tensors in :attr:`buffers`, which define the state of the observable.
+
+    Args:
+        name (str): name under which the observable is stored
+    """
+
+    buffers = ()
+
+    def __init__(self, name):
+        self.name = name
+
+    @abstractmethod
+    def update(self, rs, weights=None):
+        r"""Accumulate a batch of samples.
+
+        Args:
+            rs (:class:`torch.Tensor`:math:`(\cdot,N,3)`): electron coordinates
+            weights (:class:`torch.Tensor`:math:`(\cdot)`): walker weights
+        """
+
+    @abstractmethod
+    def result(self):
+        """Return the accumulated observable as a dictionary of arrays."""
+
+    def state_dict(self):
+        return {name: getattr(self, name).clone() for name in self.buffers}
+
+    def load_state_dict(self, state_dict):
+        for name in self.buffers:
+            setattr(self, name, state_dict[name].to(getattr(self, name)))
+
+    def to_h5(self, group):
+        """Store the result in a HDF5 group, replacing a previous result.
+
+        Args:
+            group (:class:`h5py.Group`): group in which the result is stored
+        """
+        if self.name in group:
+            del group[self.name]
+        subgroup = group.create_group(self.name)
+        for label, value in self.result().items():
+            subgroup.create_dataset(label, data=value)
+
+
+class Histogram(Observable):
+    # accumulates weighted counts of values in channels, values outside of
+    # the bins are counted only in the total weight
+    buffers = ('counts', 'weight')
+
+    def __init__(self, name, n_channels, bounds, n_bins):
+        super().__init__(name)
+        self.bounds = torch.tensor(bounds, dtype=torch.float)
+        self.n_bins = torch.tensor(n_bins)
+        self.counts = torch.zeros(n_channels, *n_bins, dtype=torch.double)
+        self.weight = torch.tensor(0, dtype=torch.double)
+
+    @property
+    def edges(self):
+        return [
+            np.linspace(lo, hi, n + 1)
+            for (lo, hi), n in zip(self.bounds.tolist(), self.n_bins.tolist())
+        ]
+
+    def accumulate(self, xs, channels, weights):
+        # xs: (..., n_dims), channels: (...) or int, weights: (batch)
+        bounds, n_bins = self.bounds.to(xs), self.n_bins.to(xs.device)
+        self.counts = self.counts.to(xs.device)
+        self.weight = self.weight.to(xs.device)
+        idxs = ((xs - bounds[:, 0]) / (bounds[:, 1] - bounds[:, 0]) * n_bins).floor()
+        mask = ((idxs >= 0) & (idxs < n_bins)).all(dim=-1)
+        idxs = idxs.long()
+        flat_idxs = channels
+        for i in range(len(n_bins)):
+            flat_idxs = flat_idxs * n_bins[i] + idxs[..., i]
+        weights = weights.to(self.counts).view(-1, *(1 for _ in xs.shape[1:-1]))
+        weights = weights.expand(xs.shape[:-1])
+        self.counts += torch.bincount(
+            flat_idxs[mask], weights[mask], minlength=self.counts.numel()
+        ).view_as(self.counts)
+
+    def _weights(self, rs, weights):
+        if weights is None:
+            weights = rs.new_ones(len(rs))
+        self.weight = self.weight.to(rs.device) + weights.sum()
+        return weights
+
+    def normalized(self, volumes):
+        # average counts per sample and unit volume
+        return (self.counts / self.weight).cpu().numpy() / volumes
+
+
+class RadialDensity(Histogram):
+    r"""Spherically averaged electron density around each nucleus.
+
+    The density is accumulated as a histogram of electron--nucleus distances.
+    The result contains the bin ``edges`` and the ``density`` with shape
+    :math:`(M,\cdot)`, the average number of electrons per unit volume in
+    a spherical shell around each nucleus.
+
+    Args:
+        coords (:class:`torch.Tensor`:math:`(M,3)`): nuclear coordinates
+        r_max (float): maximum electron--nucleus distance
+        n_bins (int): number of bins
+        name (str): name under which the observable is stored
+    """
+
+    def __init__(self, coords, r_max, n_bins=100, name='radial_density'):
+        super().__init__(name, len(coords), [(0, r_max)], [n_bins])
+        self.coords = coords
+
+    def update(self, rs, weights=None):
+        weights = self._weights(rs, weights)
+        dists = pairwise_distance(rs, self.coords.to(rs))
+        channels = torch.arange(dists.shape[-1], device=rs.device)
+        self.accumulate(dists[..., None], channels, weights)
+
+    def result(self):
+        (edges,) = self.edges
+        volumes = 4 / 3 * np.pi * np.diff(edges ** 3)
+        return {'edges': edges, 'density': self.normalized(volumes)}
+
+
+class DensityGrid(Histogram):
+    r"""Electron density on a regular grid.
+
+    The result contains the bin edges ``edges_x``, ``edges_y``, ``edges_z``
+    and the ``density`` with shape :math:`(N_x,N_y,N_z)`, the average number
+    of electrons per unit volume in each voxel.
+
+    Args:
+        bounds (list): lower and upper bounds of the grid along each axis
+        n_points (int or list): number of voxels in total or along each axis
+        name (str): name under which the observable is stored
+    """
+
+    def __init__(self, bounds, n_points=50, name='density'):
+        if isinstance(n_points, int):
+            n_points = 3 * [n_points]
+        super().__init__(name, 1, bounds, n_points)
+
+    def update(self, rs, weights=None):
+        weights = self._weights(rs, weights)
+        self.accumulate(rs, 0, weights)
+
+    def result(self):
+        edges = self.edges
+        dx, dy, dz = np.ix_(*(np.diff(e) for e in edges))
+        volumes = dx * dy * dz
+        return {
+            **{f'edges_{ax}': e for ax, e in zip('xyz', edges)},
+            'density': self.normalized(volumes)[0],
+        }
+
+
+class PairDistances(Histogram):
+    r"""Spin-resolved distribution of electron--electron distances.
+
+    The result contains the bin ``edges`` and the pair densities ``uu``,
+    ``dd``, and ``ud``, the average number of electron pairs of the given
+    spins per unit distance.
+
+    Args:
+        n_up (int): number of spin-up electrons
+        r_max (float): maximum electron--electron distance
+        n_bins (int): number of bins
+        name (str): name under which the observable is stored
+    """
+
+    def __init__(self, n_up, r_max, n_bins=100, name='pair_distances'):
+        super().__init__(name, 3, [(0, r_max)], [n_bins])
+        self.n_up = n_up
+
+    def update(self, rs, weights=None):
+        weights = self._weights(rs, weights)
+        rs_up, rs_down = rs[:, : self.n_up], rs[:, self.n_up :]
+        pairs = [
+            pairwise_self_distance(rs_up),
+            pairwise_self_distance(rs_down),
+            pairwise_distance(rs_up, rs_down).flatten(start_dim=1),
+        ]
+        channels = torch.repeat_interleave(
+            torch.arange(3, device=rs.device),
+            torch.tensor([d.shape[1] for d in pairs], device=rs.device),
+        )
+        self.accumulate(torch.cat(pairs, dim=1)[..., None], channels, weights)
+
+    def result(self):
+        (edges,) = self.edges
+        uu, dd, ud = self.normalized(np.diff(edges))
+        return {'edges': edges, 'uu': uu, 'dd': dd, 'ud': ud}
@@ -53,12 +53,17 @@ def electronic_potential(rs):
     return (1 / dists).sum(dim=-1)
 
 
+def nan_mask(*xs):
+    # marks walkers, indexed by the first dimension, with any nan value
+    masks = [torch.isnan(x.reshape(len(x), -1)).any(dim=-1) for x in xs]
+    return torch.stack(masks).any(dim=0)
+
+
 def quantum_force(rs, wf):
     forces, psis = grad(rs, wf)
-    if torch.isnan(psis[0]).any():
-        raise NanError(rs)
-    if torch.isnan(forces).any():
-        raise NanError(rs)
+    mask = nan_mask(psis[0], forces)
+    if mask.any():
+        raise NanError(rs, mask)
     return forces, psis
 
 
@@ -111,12 +116,9 @@ def local_energy(
     lap_log_psis, (log_psis, sign_psis), quantum_force = laplacian(
         rs, wf, create_graph=create_graph, keep_graph=keep_graph, return_grad=True
     )
-    if torch.isnan(log_psis).any():
-        raise NanError(rs)
-    if torch.isnan(quantum_force).any():
-        raise NanError(rs)
-    if torch.isnan(lap_log_psis).any():
-        raise NanError(rs)
+    mask = nan_mask(log_psis, quantum_force, lap_log_psis)
+    if mask.any():
+        raise NanError(rs, mask)
     Es_loc = (
         -0.5 * (lap_log_psis + (quantum_force ** 2).sum(dim=(-2, -1)))
         + Vs_nuc
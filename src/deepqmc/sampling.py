@@ -5,12 +5,12 @@ from itertools import count
 import numpy as np
 import torch
 from torch.utils.data import DataLoader, TensorDataset
-from uncertainties import ufloat, unumpy as unp
 
-from .errors import LUFactError
+from .blocking import BlockingAccumulator
+from .errors import LUFactError, NanError
 from .physics import clean_force, local_energy, pairwise_self_distance, quantum_force
 from .plugins import PLUGINS
-from .torchext import assign_where
+from .torchext import assign_where, compile_module, frozen_parameters
 from .utils import energy_offset
 
 __version__ = '0.3.0'
@@ -27,6 +27,8 @@ def sample_wf(  # noqa: C901
     write_figures=False,
     log_dict=None,
     blocks=None,
+    accumulator=None,
+    sample_plugin=None,
     *,
     block_size=10,
     equilibrate=True,
@@ -47,18 +49,28 @@ def sample_wf(  # noqa: C901
         writer (:class:`torch.utils.tensorboard.writer.SummaryWriter`):
             Tensorboard writer
         log_dict (dict-like): step data will be stored in this dictionary if given
-        blocks (list): used as storage of blocks. If not given, the iterator
-            uses a local storage.
+        blocks (list): if given, every full block is appended to it as an array
+            of per-walker block averages and their standard errors with shape
+            :math:`(\cdot,2)`
+        accumulator (:class:`~deepqmc.blocking.BlockingAccumulator`): if given,
+            the block averages are accumulated in it, which allows continuing
+            a previous estimate
+        sample_plugin (callable): called in each step after equilibration with
+            the wave function, the sampled electron coordinates, and a dictionary
+            of the step data, which are then stored in *log_dict*, defaults to
+            ``PLUGINS['sample_plugin']``, see
+            :func:`~deepqmc.observables.observables_plugin`
         block_size (int): size of a block (a sequence of samples)
         equilibrate (bool or int): if false, local energies are calculated and
             accumulated from the first sampling step, if true equilibrium is
             detected automatically, if integer argument, specifies number of
             equilibration steps
     """
-    blocks = blocks if blocks is not None else []
+    accumulator = accumulator if accumulator is not None else BlockingAccumulator()
     calculating_energy = not equilibrate
     buffer = []
-    energy = None
+    energy = accumulator.value if accumulator.n_blocks else None
+    sample_plugin = sample_plugin or PLUGINS.get('sample_plugin')
     for step, (rs, log_psis, _, info) in zip(steps, sampler):
         if step == 0:
             dist_means = rs.new_zeros(5 * block_size)
@@ -76,26 +88,42 @@ def sample_wf(  # noqa: C901
             if calculating_energy:
                 yield step, 'eq'
         if calculating_energy:
-            Es_loc = local_energy(rs, wf, keep_graph=False)[0]
-            buffer.append(Es_loc)
-            if log_dict is not None:
-                log_dict['coords'] = rs.cpu().numpy()
-                log_dict['E_loc'] = Es_loc.cpu().numpy()
-                log_dict['log_psis'] = log_psis.cpu().numpy()
-            if 'sample_plugin' in PLUGINS:
-                PLUGINS['sample_plugin'](wf, rs, log_dict)
+            with frozen_parameters(wf):
+                Es_loc = local_energy(rs, wf, keep_graph=False)[0]
+            # the total walker weight is conserved, so weighted local energies
+            # can be averaged directly
+            weights = info.get('weights')
+            buffer.append(Es_loc if weights is None else weights * Es_loc)
+            if log_dict is not None or sample_plugin:
+                # the plugin can read and extend the step data before they
+                # are logged, as log_dict may be write-only
+                step_data = {
+                    'coords': rs.cpu().numpy(),
+                    'E_loc': Es_loc.cpu().numpy(),
+                    'log_psis': log_psis.cpu().numpy(),
+                }
+                if weights is not None:
+                    step_data['weights'] = weights.cpu().numpy()
+                if sample_plugin:
+                    sample_plugin(wf, rs, step_data)
+                if log_dict is not None:
+                    for label, value in step_data.items():
+                        log_dict[label] = value
             if len(buffer) == block_size:
                 buffer = torch.stack(buffer)
-                block = unp.uarray(
-                    buffer.mean(dim=0).cpu(),
-                    buffer.std(dim=0).cpu() / np.sqrt(len(buffer)),
+                block = (
+                    torch.stack(
+                        [buffer.mean(dim=0), buffer.std(dim=0) / np.sqrt(len(buffer))],
+                        dim=-1,
+                    )
+                    .cpu()
+                    .numpy()
                 )
-                blocks.append(block)
+                if blocks is not None:
+                    blocks.append(block)
+                accumulator.update(block[:, 0])
+                energy = accumulator.value
                 buffer = []
-            if not buffer:
-                blocks_arr = unp.nominal_values(np.stack(blocks, -1))
-                err = blocks_arr.mean(-1).std() / np.sqrt(len(blocks_arr))
-                energy = ufloat(blocks_arr.mean(), err)
         if writer:
             if calculating_energy:
                 writer.add_scalar('E_loc/mean', Es_loc.mean() - energy_offset, step)
@@ -126,7 +154,7 @@ def sample_wf(  # noqa: C901
                     if not buffer:
                         fig = Figure(dpi=300)
                         ax = fig.subplots()
-                        ax.hist(blocks_arr.flatten(), bins=100)
+                        ax.hist(block[:, 0], bins=100)
                         writer.add_figure('E_block', fig, step)
         if calculating_energy:
             yield step, energy
@@ -178,6 +206,28 @@ class MetropolisSampler(Sampler):
             moved with 100% acceptance
         log_psi_threshold (float): steps into proposals with log wave function values
             below this threshold are always rejected
+        max_nan_fraction (float): maximum fraction of walkers with a nan wave
+            function value or quantum force that are quarantined, that is,
+            rejected when proposed or reset from healthy walkers on restart,
+            before :class:`~deepqmc.errors.NanError` is raised
+        recycle_age (int): walkers without a move for this number of steps are
+            recycled, see below
+        recycle_log_psi (float): walkers with log wave function values lower than
+            the median by more than this margin are recycled. Recycling is a
+            split--join population control: each recycled walker is joined with
+            a random healthy walker into one walker that carries the summed
+            weight, and the freed slot is filled by splitting the heaviest
+            healthy walkers into two halves. The total weight is conserved, and
+            the per-walker weights are reported in the step info.
+        quarantine (callable): called with the coordinates of quarantined
+            walkers, e.g. to store them for debugging
+        compiled (bool): whether the wave function is evaluated in the
+            proposals and in :meth:`recompute_psi` with a compiled graph, built
+            with :func:`torch.compile` where available, otherwise traced with
+            TorchScript. A graph is compiled for each batch shape and data type,
+            and compiled again when the buffers or the shapes of the parameters
+            of the wave function change. The wave function must not branch on
+            the values of its input.
     """
 
     def __init__(
@@ -185,6 +235,7 @@ class MetropolisSampler(Sampler):
         wf,
         rs,
         writer=None,
+        quarantine=None,
         *,
         tau=0.1,
         n_first_certain=3,
@@ -193,17 +244,28 @@ class MetropolisSampler(Sampler):
         n_decorrelate=1,
         max_age=None,
         log_psi_threshold=None,
+        max_nan_fraction=0.01,
+        recycle_age=None,
+        recycle_log_psi=None,
+        compiled=False,
     ):
         super().__init__()
         self.wf = wf
+        self.compiled = compiled
+        self._compiled_wfs = {}
+        self.max_nan_fraction = max_nan_fraction
+        self.quarantine = quarantine
         self.max_age = max_age
         self.n_first_certain = n_first_certain
         self.log_psi_threshold = log_psi_threshold
         self.target_acceptance = target_acceptance
         self.n_discard = n_discard
         self.n_decorrelate = n_decorrelate
+        self.recycle_age = recycle_age
+        self.recycle_log_psi = recycle_log_psi
         self.state['rs'] = rs.clone()
         self.state['tau'] = tau
+        self.state['weights'] = rs.new_ones(len(rs))
         self.restart()
         self.writer = writer
         self._step_writer = 0
@@ -224,6 +286,10 @@ class MetropolisSampler(Sampler):
     def _ages(self):
         return self.state['ages']
 
+    @property
+    def weights(self):
+        return self.state['weights']
+
     @property
     def tau(self):
         return self.state['tau']
@@ -231,9 +297,26 @@ class MetropolisSampler(Sampler):
     def proposal(self):
         return self.rs + torch.randn_like(self.rs) * self.tau
 
+    def wf_for(self, rs):
+        r"""Return the wave function used to evaluate a batch of coordinates.
+
+        Args:
+            rs (:class:`torch.Tensor`:math:`(\cdot,N,3)`): electron coordinates
+        """
+        if not self.compiled:
+            return self.wf
+        key = rs.shape, rs.dtype, rs.device
+        signature = _compile_signature(self.wf)
+        compiled_signature, wf = self._compiled_wfs.get(key, (None, None))
+        if compiled_signature != signature:
+            with torch.no_grad():
+                wf = compile_module(self.wf, rs.detach())
+            self._compiled_wfs[key] = signature, wf
+        return wf
+
     def acceptance_prob(self, rs):
-        with torch.no_grad:
-            log_psis, sign_psis = self.wf(rs)
+        with torch.no_grad():
+            log_psis, sign_psis = self.wf_for(rs)(rs)
         Ps_acc = torch.exp(2 * (log_psis - self.log_psis))
         # Ps_acc might become 0 or inf, however this does not affect
         # the stability of the remaining code
@@ -271,8 +354,12 @@ class MetropolisSampler(Sampler):
         return cls(wf, rs, **kwargs)
 
     def step(self):
-        rs = self.proposal()
-        Ps_acc, log_psis, sign_psis, *extra_vars = self.acceptance_prob(rs)
+        with frozen_parameters(self.wf):
+            rs = self.proposal()
+            Ps_acc, log_psis, sign_psis, *extra_vars = self.acceptance_prob(rs)
+        is_nan = torch.isnan(log_psis)
+        if is_nan.any():
+            self.quarantine_walkers(rs, is_nan)
         accepted = Ps_acc > torch.rand_like(Ps_acc)
         if self.log_psi_threshold is not None:
             accepted = accepted & (log_psis > self.log_psi_threshold) | (
@@ -282,6 +369,7 @@ class MetropolisSampler(Sampler):
             accepted = accepted | (self._ages >= self.max_age)
         if self.state['step'] < self.n_first_certain:
             accepted = torch.ones_like(accepted)
+        accepted = accepted & ~is_nan
         self._ages[accepted] = 0
         self._ages[~accepted] += 1
         acceptance = accepted.type(torch.int).sum().item() / self.rs.shape[0]
@@ -289,12 +377,15 @@ class MetropolisSampler(Sampler):
             'acceptance': acceptance,
             'age': self._ages.cpu().numpy(),
             'tau': self.tau,
+            'quarantined': is_nan.sum().item(),
         }
         assign_where(
             (self.rs, self.log_psis, self.sign_psis, *self.extra_vars()),
             (rs, log_psis, sign_psis, *extra_vars),
             accepted,
         )
+        info['recycled'] = self.recycle()
+        info['weights'] = self.weights.clone()
         if self.target_acceptance:
             self.state['tau'] /= self.target_acceptance / max(acceptance, 0.05)
         self.state['step'] += 1
@@ -310,6 +401,9 @@ class MetropolisSampler(Sampler):
             )
             self.writer.add_scalar('sampling/acceptance', acceptance, self._step_writer)
             self.writer.add_scalar('sampling/tau', self.tau, self._step_writer)
+            self.writer.add_scalar(
+                'sampling/quarantined', info['quarantined'], self._step_writer
+            )
             self.writer.add_scalar(
                 'sampling/age/max', info['age'].max(), self._step_writer
             )
@@ -318,9 +412,44 @@ class MetropolisSampler(Sampler):
                 np.sqrt((info['age'] ** 2).mean()),
                 self._step_writer,
             )
+            self.writer.add_scalar(
+                'sampling/age/recycled', info['recycled'], self._step_writer
+            )
             self.extra_writer()
         return self.rs.clone(), self.log_psis.clone(), self.sign_psis.clone(), info
 
+    def recycle(self):
+        stuck = torch.zeros_like(self._ages, dtype=torch.bool)
+        if self.recycle_age is not None:
+            stuck = stuck | (self._ages >= self.recycle_age)
+        if self.recycle_log_psi is not None:
+            stuck = stuck | (
+                self.log_psis < self.log_psis.median() - self.recycle_log_psi
+            )
+        (stuck_idxs,) = stuck.nonzero(as_tuple=True)
+        (healthy_idxs,) = stuck.logical_not().nonzero(as_tuple=True)
+        n = min(len(stuck_idxs), len(healthy_idxs) // 2)
+        if n == 0:
+            return 0
+        stuck_idxs = stuck_idxs[torch.randperm(len(stuck_idxs))[:n]]
+        healthy_idxs = healthy_idxs[torch.randperm(len(healthy_idxs))]
+        partners, others = healthy_idxs[:n], healthy_idxs[n:]
+        donors = others[self.weights[others].topk(n).indices]
+        # join: the survivor, chosen with probability proportional to weight,
+        # takes the slot of the partner and carries the summed weight
+        ws_join = self.weights[stuck_idxs] + self.weights[partners]
+        keep_stuck = torch.rand_like(ws_join) * ws_join < self.weights[stuck_idxs]
+        survivors = torch.where(keep_stuck, stuck_idxs, partners)
+        # split: the freed slot is filled by a clone of a heavy walker
+        for x in (self.rs, self.log_psis, self.sign_psis, *self.extra_vars()):
+            x[partners] = x[survivors]
+            x[stuck_idxs] = x[donors]
+        self.weights[partners] = ws_join
+        self.weights[donors] = self.weights[donors] / 2
+        self.weights[stuck_idxs] = self.weights[donors]
+        self._ages[torch.cat([stuck_idxs, partners])] = 0
+        return n
+
     def iter_with_info(self):
         for i in count(-self.n_discard):
             sample = self.step()
@@ -336,7 +465,8 @@ class MetropolisSampler(Sampler):
 
         Each epoch, the wave function is sampled in one shot, the samples
         are buffered, and used to form all batches within a given epoch, entirely
-        shuffled.
+        shuffled. Walker weights from recycling are absorbed into the yielded
+        log wave function values, which enter only importance-sampling weights.
 
         Args:
             epoch_size (int): number of batches per epoch
@@ -346,18 +476,39 @@ class MetropolisSampler(Sampler):
         n_total = epoch_size * batch_size
         n_steps = math.ceil(n_total / len(self))
         while True:
-            xs = samples_from(self, range(n_steps))
+            *xs, infos = samples_from(self.iter_with_info(), range(n_steps))
+            # walker weights enter the importance-sampling weights of the batch
+            weights = torch.stack([info['weights'] for info in infos], dim=1)
+            xs[1] = xs[1] - weights.log() / 2
             samples_ds = TensorDataset(*(x.flatten(end_dim=1)[:n_total] for x in xs))
             rs_dl = DataLoader(samples_ds, batch_size=batch_size, shuffle=True)
             yield from rs_dl
             self.restart()
 
     def recompute_psi(self):
-        self.state['log_psis'], self.state['sign_psis'] = self.wf(self.rs)
+        with torch.no_grad():
+            log_psis, sign_psis = self.wf_for(self.rs)(self.rs)
+        self.state['log_psis'], self.state['sign_psis'] = log_psis, sign_psis
+
+    def quarantine_walkers(self, rs, mask):
+        n_nan = mask.sum().item()
+        if n_nan > self.max_nan_fraction * len(mask) or n_nan == len(mask):
+            raise NanError(rs, mask)
+        log.warning(f'Quarantining {n_nan} walkers with nan values')
+        if self.quarantine:
+            self.quarantine(rs[mask])
 
     def restart(self):
         self.state['step'] = 0
-        self.recompute_psi()
+        with frozen_parameters(self.wf):
+            self.recompute_psi()
+        is_nan = torch.isnan(self.log_psis)
+        if is_nan.any():
+            self.quarantine_walkers(self.rs, is_nan)
+            healthy = is_nan.logical_not().nonzero(as_tuple=True)[0]
+            idxs = healthy[torch.randint(len(healthy), (is_nan.sum().item(),))]
+            for x in (self.rs, self.log_psis, self.sign_psis, *self.extra_vars()):
+                x[is_nan] = x[idxs]
         self.state['ages'] = torch.zeros_like(self.log_psis, dtype=torch.long)
 
     def propagate_all(self):
@@ -365,6 +516,17 @@ class MetropolisSampler(Sampler):
         self.restart()
 
 
+def _compile_signature(wf):
+    # a compiled graph reads the parameters at each call, but records indexes
+    # derived from the buffers, the parameter shapes, and the modes as constants
+    return (
+        wf.training,
+        getattr(wf, 'sampling', None),
+        tuple((x.data_ptr(), x._version, x.shape) for x in wf.buffers()),
+        tuple((p.data_ptr(), p.shape) for p in wf.parameters()),
+    )
+
+
 def rand_from_mol(mol, bs, pop_charges=None, elec_std=1.0):
     n_atoms = len(mol)
     charges = mol.charges
@@ -420,10 +582,21 @@ class LangevinSampler(MetropolisSampler):
 
     def qforce(self, rs):
         try:
-            forces, (log_psis, sign_psis) = quantum_force(rs, self.wf)
+            forces, (log_psis, sign_psis) = quantum_force(rs, self.wf_for(rs))
         except LUFactError as e:
             e.info['rs'] = rs[e.info['idxs']]
             raise
+        except NanError as e:
+            # nan walkers are masked here and quarantined by the caller, the
+            # healthy walkers are evaluated eagerly, as their number varies
+            healthy = ~e.mask
+            forces = torch.zeros_like(rs)
+            log_psis = rs.new_full(rs.shape[:1], float('nan'))
+            sign_psis = torch.zeros_like(log_psis)
+            (
+                forces[healthy],
+                (log_psis[healthy], sign_psis[healthy]),
+            ) = quantum_force(rs[healthy], self.wf)
         forces = clean_force(forces, rs, self.wf.mol, tau=self.tau)
         return forces, (log_psis, sign_psis)
 
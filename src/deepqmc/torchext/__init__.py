@@ -7,11 +7,14 @@ from .utils import (
     batch_eval,
     batch_eval_tuple,
     bdiag,
+    compile_module,
+    frozen_parameters,
     get_custom_dnn,
     get_log_dnn,
     idx_comb,
     idx_perm,
     is_cuda,
+    is_tracing,
     merge_tensors,
     normalize_mean,
     number_of_parameters,
@@ -30,12 +33,15 @@ __all__ = [
     'batch_eval_tuple',
     'bdet',
     'bdiag',
+    'compile_module',
     'estimate_optimal_batch_size_cuda',
+    'frozen_parameters',
     'get_custom_dnn',
     'get_log_dnn',
     'idx_comb',
     'idx_perm',
     'is_cuda',
+    'is_tracing',
     'merge_tensors',
     'normalize_mean',
     'number_of_parameters',
@@ -65,25 +65,54 @@ def _slogcof(A):
     return (*sl_C, U, s, V, sgn_UV)
 
 
-def _sloglindet_ref(c, A1, A2):
-    Psi = (c * A1.det() * A2.det()).sum(dim=-1)
+def _sloglindet_ref(c, A1, A2, idx1=None, idx2=None):
+    D1, D2 = A1.det(), A2.det()
+    if idx1 is not None:
+        D1 = D1[..., idx1]
+    if idx2 is not None:
+        D2 = D2[..., idx2]
+    Psi = (c * D1 * D2).sum(dim=-1)
     return Psi.sign(), Psi.abs().log()
 
 
+# A determinant can be shared by several terms, in which case the matrices
+# are given only once and idx maps the terms to the matrices. The functions
+# below map signed logarithms of per-matrix quantities to per-term ones and
+# sum per-term quantities back to per-matrix ones.
+
+
+def _gather_terms(sl_x, idx):
+    if idx is None:
+        return sl_x
+    return tuple(x[..., idx] for x in sl_x)
+
+
+def _sum_terms(sl_x, idx, n):
+    if idx is None:
+        return sl_x
+    return slog_fn_exp(
+        lambda x: x.new_zeros(*x.shape[:-1], n).index_add_(-1, idx, x),
+        sl_x,
+        dim=-1,
+        idx=(..., None),
+    )
+
+
 class SLogLinearDet(torch.autograd.Function):
     @staticmethod
-    def forward(ctx, c, A1, A2):
+    def forward(ctx, c, A1, A2, idx1=None, idx2=None):
         assert len(c.shape) == 1
         assert len(A1.shape) >= 3
         assert len(A2.shape) >= 3
-        assert A1.shape[-3] == A2.shape[-3] == c.shape[0]
+        for A, idx in [(A1, idx1), (A2, idx2)]:
+            assert (A.shape[-3] if idx is None else len(idx)) == c.shape[0]
         assert A1.shape[:-3] == A2.shape[:-3]
         assert A1.shape[-1] == A1.shape[-2]
         assert A2.shape[-1] == A2.shape[-2]
         # TODO deal with special cases of n = 0 and n = 1
         assert A1.shape[-1] > 1 and A2.shape[-1] > 1
-        sl_D1 = A1.slogdet()
-        sl_D2 = A2.slogdet()
+        sl_D1 = _gather_terms(A1.slogdet(), idx1)
+        sl_D2 = _gather_terms(A2.slogdet(), idx2)
         sl_D = sl_D1[0] * sl_D2[0], sl_D1[1] + sl_D2[1]
         sl_Psi = slog_fn_exp(lambda D: (c * D).sum(dim=-1), sl_D, dim=-1)
         # The cofactor matrices are calculated here, because their calculation
@@ -92,14 +121,24 @@ class SLogLinearDet(torch.autograd.Function):
         # This solution is hugely suboptimal if only forward pass is needed (by
         # ~1.5 order of magnitude), but that never happens in normal use of our code
         ctx.save_for_backward(
-            c, A1, A2, *_slogcof(A1), *_slogcof(A2), *sl_Psi, *sl_D, *sl_D1, *sl_D2
+            c,
+            A1,
+            A2,
+            idx1,
+            idx2,
+            *_slogcof(A1),
+            *_slogcof(A2),
+            *sl_Psi,
+            *sl_D,
+            *sl_D1,
+            *sl_D2,
         )
         return sl_Psi
 
     @staticmethod
     def backward(ctx, _, Pb):
         cb, A1b, A2b = SLogLinearDetBackward.apply(Pb, *ctx.saved_tensors)
-        return cb, A1b, A2b
+        return cb, A1b, A2b, None, None
 
 
 def _backward_sloglin(Pb, sl_c, sl_Psi, sl_D):
@@ -120,7 +159,7 @@ def _backward_det(sl_Db, sl_C):
 class SLogLinearDetBackward(torch.autograd.Function):
     @staticmethod
     def forward(ctx, Pb, *args):
-        c, A1, A2, *args = args
+        c, A1, A2, idx1, idx2, *args = args
         *sl_C1, U1, s1, V1, sgn_UV1 = args[:6]
         *sl_C2, U2, s2, V2, sgn_UV2 = args[6:12]
         sl_Psi, sl_D, sl_D1, sl_D2 = zip(args[12::2], args[13::2])
@@ -129,10 +168,14 @@ class SLogLinearDetBackward(torch.autograd.Function):
         # backward through D = D1 * D2
         sl_D1b = sl_Db[0] * sl_D2[0], sl_Db[1] + sl_D2[1]
         sl_D2b = sl_Db[0] * sl_D1[0], sl_Db[1] + sl_D1[1]
+        sl_D1b = _sum_terms(sl_D1b, idx1, A1.shape[-3])
+        sl_D2b = _sum_terms(sl_D2b, idx2, A2.shape[-3])
         A1b = _backward_det(sl_D1b, sl_C1)
         A2b = _backward_det(sl_D2b, sl_C2)
         ctx.save_for_backward(
             Pb,
+            idx1,
+            idx2,
             *(U1, V1, s1, sgn_UV1),
             *(U2, V2, s2, sgn_UV2),
             *(*sl_Db, *sl_Psi, *sl_D, *sl_c),
@@ -146,7 +189,7 @@ class SLogLinearDetBackward(torch.autograd.Function):
         Pbt, ct, A1t, A2t = SLogLinearDetDoubleBackward.apply(
             cbt, A1bt, A2bt, *ctx.saved_tensors
         )
-        return (Pbt, ct, A1t, A2t, *(20 * [None]))
+        return (Pbt, ct, A1t, A2t, *(22 * [None]))
 
 
 def _double_backward_det(Abt, U, V, sgn_UV, s, sl_C, sl_Db):
@@ -215,12 +258,14 @@ def _double_backward_sloglin(cbt, sl_Dbt, sl_D, sl_Psi, sl_c, Pb):
 class SLogLinearDetDoubleBackward(torch.autograd.Function):
     @staticmethod
     def forward(ctx, cbt, A1bt, A2bt, *args):
-        Pb, U1, V1, s1, sgn_UV1, U2, V2, s2, sgn_UV2, *args = args
+        Pb, idx1, idx2, U1, V1, s1, sgn_UV1, U2, V2, s2, sgn_UV2, *args = args
         sl_Db, sl_Psi, sl_D, sl_c, sl_C1, sl_D1, sl_D1b, sl_C2, sl_D2, sl_D2b = zip(
             args[::2], args[1::2]
         )
         sl_D1bt, A1t = _double_backward_det(A1bt, U1, V1, sgn_UV1, s1, sl_C1, sl_D1b)
         sl_D2bt, A2t = _double_backward_det(A2bt, U2, V2, sgn_UV2, s2, sl_C2, sl_D2b)
+        sl_D1bt = _gather_terms(sl_D1bt, idx1)
+        sl_D2bt = _gather_terms(sl_D2bt, idx2)
         # double backward through D = D1 * D2
         sl_Dbt = slog_fn_exp(
             lambda x: x.sum(dim=-1),
@@ -238,6 +283,8 @@ class SLogLinearDetDoubleBackward(torch.autograd.Function):
         sl_D2t = slog_fn_exp(
             lambda x: x.sum(dim=-1), sl_D2t, (sl_D1[0] * sl_Dt[0], sl_D1[1] + sl_Dt[1])
         )
+        sl_D1t = _sum_terms(sl_D1t, idx1, A1t.shape[-3])
+        sl_D2t = _sum_terms(sl_D2t, idx2, A2t.shape[-3])
         # reverse through Di = det Ai
         idx = ..., None, None
         A1t = A1t + sl_D1t[0][idx] * sl_C1[0] * (sl_D1t[1][idx] + sl_C1[1]).exp()
@@ -1,5 +1,8 @@
+import warnings
 from collections import OrderedDict
+from contextlib import contextmanager
 from functools import lru_cache
+from importlib import import_module
 from itertools import combinations, permutations
 
 # TODO remove use of numpy (torch, math)
@@ -21,6 +24,57 @@ def state_dict_copy(net):
     return {name: val.cpu() for name, val in net.state_dict().items()}
 
 
+@contextmanager
+def frozen_parameters(net):
+    # autograd then records only the input-dependent part of the graph, so
+    # derivatives with respect to electron coordinates remain available
+    params = [p for p in net.parameters() if p.requires_grad]
+    for p in params:
+        p.requires_grad_(False)
+    try:
+        yield net
+    finally:
+        for p in params:
+            p.requires_grad_(True)
+
+
+def is_tracing():
+    # Python-side caches and branches on tensor values are recorded as
+    # constants in a traced or compiled graph, so they must be avoided.
+    # torch.jit.is_tracing() is not usable in older versions of PyTorch
+    is_compiling = _dynamo_is_compiling()
+    tracing = torch._C._get_tracing_state() is not None
+    return tracing or bool(is_compiling and is_compiling())
+
+
+@lru_cache()
+def _dynamo_is_compiling():
+    # torch.compiler.is_compiling() is available from PyTorch 2.3, earlier
+    # versions with torch.compile provide torch._dynamo.is_compiling()
+    is_compiling = getattr(getattr(torch, 'compiler', None), 'is_compiling', None)
+    if is_compiling or not hasattr(torch, 'compile'):
+        return is_compiling
+    try:
+        dynamo = import_module('torch._dynamo')
+    except ImportError:
+        return None
+    return getattr(dynamo, 'is_compiling', None)
+
+
+def compile_module(net, example):
+    """Compile a module into a graph specialized to an example input.
+
+    Uses :func:`torch.compile` where available, otherwise the module is traced
+    with TorchScript. The compiled module shares the parameters of *net*.
+    """
+    if hasattr(torch, 'compile'):
+        return torch.compile(net, dynamic=False)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        warnings.filterwarnings('ignore', 'Iterating over a tensor', RuntimeWarning)
+        return torch.jit.trace(net, example, check_trace=False)
+
+
 def normalize_mean(x):
     return x / x.mean()
 
@@ -53,8 +107,7 @@ def shuffle_tensor(x):
 
 
 def triu_flat(x):
-    # TODO use idx_comb()
-    i, j = np.triu_indices(x.shape[1], k=1)
+    i, j = idx_comb(x.shape[1], 2, x.device)
     return x[:, i, j, ...]
 
 
@@ -84,7 +137,7 @@ def batch_eval_tuple(func, batches, *args, **kwargs):
 @lru_cache()
 def idx_perm(n, r, device=torch.device('cpu')):  # noqa: B008
     idx = list(permutations(range(n), r))
-    idx = torch.tensor(idx, device=device).t()
+    idx = torch.tensor(idx, dtype=torch.long, device=device).view(-1, r).t()
     idx = idx.view(r, *range(n, n - r, -1))
     return idx
 
@@ -92,7 +145,7 @@ def idx_perm(n, r, device=torch.device('cpu')):  # noqa: B008
 @lru_cache()
 def idx_comb(n, r, device=torch.device('cpu')):  # noqa: B008
     idx = list(combinations(range(n), r))
-    idx = torch.tensor(idx, device=device).t()
+    idx = torch.tensor(idx, dtype=torch.long, device=device).view(-1, r).t()
     return idx
 
 
@@ -11,13 +11,13 @@ import torch
 from torch.utils.tensorboard import SummaryWriter
 from tqdm.auto import tqdm, trange
 
-from .errors import NanError, TrainingBlowup, TrainingCrash
+from .errors import DeepQMCError, NanError, TrainingBlowup, TrainingCrash
 from .ewm import EWMMonitor
 from .fit import LossEnergy, fit_wf
 from .plugins import PLUGINS
 from .sampling import LangevinSampler, sample_wf
 from .torchext import is_cuda
-from .utils import H5LogTable
+from .utils import CheckpointStore, CheckpointWriter, H5LogTable
 
 __version__ = '0.1.0'
 __all__ = ['train']
@@ -63,12 +63,16 @@ def train(  # noqa: C901
     epoch_size=100,
     optimizer='AdamW',
     learning_rate=0.01,
+    keep_states=None,
+    prune_every=None,
+    prune_threshold=1e-3,
     optimizer_kwargs=OPTIMIZER_KWARGS,
     lr_scheduler='CyclicLR',
     lr_scheduler_kwargs=SCHEDULER_KWARGS,
     equilibrate=True,
     fit_kwargs=None,
     sampler_kwargs=None,
+    chkpts_kwargs=None,
 ):
     r"""Train a wave function model.
 
@@ -83,11 +87,21 @@ def train(  # noqa: C901
             parameter states, and HDF5 file with the fit trajectory
         save_every (int): number of steps between storing current parameter state
         state (dict): restore optimizer and scheduler states from a stored state
+        chkpts (list or :class:`~deepqmc.utils.CheckpointStore`): in-memory
+            storage of training states used for rewinding
         n_steps (int): number of optimization steps
         batch_size (int): number of samples used in a single step
         epoch_size (int): number of steps between sampling from the wave function
         optimizer (str): name of the optimizer from :mod:`torch.optim`
         learning_rate (float): learning rate for gradient-descent optimizers
+        keep_states (int): number of most recent parameter states kept on disk,
+            all are kept if :data:`None`
+        prune_every (int): if given, number of steps between pruning the
+            configurations of the wave function, see
+            :meth:`~deepqmc.wf.PauliNet.prune_configurations_`
+        prune_threshold (float): configurations whose contribution relative to
+            the largest one, averaged over the sampled walkers, is below this
+            threshold are pruned, the first configuration is always kept
         optimizer_kwargs (dict): extra arguments passed to the optimizers, organized
             by optimizer name
         lr_scheduler (str): name of the learning rate scheduling scheme
@@ -103,7 +117,15 @@ def train(  # noqa: C901
         fit_kwargs (dict): arguments passed to :func:`~deepqmc.fit.fit_wf`
         sampler_kwargs (dict): arguments passed to
             :class:`~deepqmc.sampling.LangevinSampler`
+        chkpts_kwargs (dict): arguments passed to
+            :class:`~deepqmc.utils.CheckpointStore`
     """
+    if prune_every:
+        if not hasattr(wf, 'prune_configurations_'):
+            raise DeepQMCError(
+                f'Configurations of {type(wf).__name__} cannot be pruned'
+            )
+        wf.check_prunable()
     if 'optimizer_factory' in PLUGINS:
         log.info('Using a plugin for optimizer_factory')
         opt = PLUGINS['optimizer_factory'](wf.parameters())
@@ -158,7 +180,7 @@ def train(  # noqa: C901
         opt.load_state_dict(state['opt'])
         if scheduler:
             scheduler.load_state_dict(state['scheduler'])
-        monitor = state['monitor']
+        monitor = deepcopy(state['monitor'])
         log.info(
             f'Restored from a state at step {init_step}, '
             f'energy {monitor.mean_of("mean_slow"):S}'
@@ -176,6 +198,7 @@ def train(  # noqa: C901
         )
         chkpts_dir = workdir / 'chkpts'
         chkpts_dir.mkdir(exist_ok=True)
+        chkpt_writer = CheckpointWriter(chkpts_dir, keep=keep_states)
         h5file = h5py.File(workdir / 'fit.h5', 'a', libver='v110')
         h5file.swmr_mode = True
         table = H5LogTable(h5file)
@@ -184,12 +207,23 @@ def train(  # noqa: C901
     else:
         writer = None
         log_dict = {}
+    if workdir:
+
+        def quarantine(rs):
+            dump = {'wf': wf.state_dict(), 'rs': rs}
+            now = datetime.now().isoformat(timespec='seconds')
+            torch.save(dump, workdir / f'quarantine-{monitor.step:05d}-{now}.pt')
+
+    else:
+        quarantine = None
     if 'sampler_factory' in PLUGINS:
         log.info('Using a plugin for sampler_factory')
         sampler = PLUGINS['sampler_factory'](wf, writer=writer)
     else:
         log.info(f'Using LangevinSampler, params = {sampler_kwargs!r}')
-        sampler = LangevinSampler.from_wf(wf, writer=writer, **(sampler_kwargs or {}))
+        sampler = LangevinSampler.from_wf(
+            wf, writer=writer, quarantine=quarantine, **(sampler_kwargs or {})
+        )
     if equilibrate:
         log.info('Equilibrating...')
         with tqdm(count(), desc='equilibrating', disable=None) as steps:
@@ -206,8 +240,11 @@ def train(  # noqa: C901
         desc='training',
         disable=None,
     )
-    chkpts = chkpts if chkpts is not None else []
+    if not isinstance(chkpts, CheckpointStore):
+        chkpts = CheckpointStore(chkpts, **(chkpts_kwargs or {}))
     last_log = 0
+    # a failed write of a state is not raised over an exception from training
+    completed = False
     try:
         for step, _ in fit_wf(
             wf,
@@ -221,6 +258,7 @@ def train(  # noqa: C901
             steps,
             log_dict=table.row if workdir else log_dict,
             writer=writer,
+            quarantine=quarantine,
             **(fit_kwargs or {}),
         ):
             # at this point, the wf model and optimizer are already at state step+1
@@ -234,6 +272,8 @@ def train(  # noqa: C901
                     raise TrainingBlowup(repr(monitor.blowup))
                 else:
                     log.warning(f'Detected training blowup in step {step}')
+            if prune_every and (step + 1) % prune_every == 0:
+                prune_configurations(wf, opt, sampler.rs, batch_size, prune_threshold)
             energy = monitor.mean_of('mean_slow')
             if energy.std_dev > 0:
                 steps.set_postfix(E=f'{energy:S}')
@@ -245,26 +285,25 @@ def train(  # noqa: C901
                 'step': step + 1,
                 'wf': wf.state_dict(),
                 'opt': opt.state_dict(),
-                'monitor': deepcopy(monitor),
+                'monitor': monitor,
             }
             if scheduler:
                 scheduler.step()
                 state['scheduler'] = scheduler.state_dict()
-            chkpts.append((step + 1, state))
-            chkpts = chkpts[-100:]
+            chkpts.append(step + 1, state)
             if workdir:
                 table.row['E_ewm'] = energy.n
-                h5file.flush()
+                table.flush()
                 if save_every and (step + 1) % save_every == 0:
-                    state_file = chkpts_dir / f'state-{step + 1:05d}.pt'
-                    torch.save(state, state_file)
-                    log.info(f'Saved state in {state_file}')
+                    chkpt_writer.save(state, step + 1)
                     if is_cuda(wf):
                         log.debug(
                             '\n' + torch.cuda.memory_summary(abbreviated=True).strip()
                         )
             if return_every and (step + 1) % return_every == 0:
+                completed = True
                 return True
+        completed = True
     except (NanError, TrainingBlowup) as e:
         step = steps.n
         log.warning(f'Caught exception in step {step}: {e!r}')
@@ -279,20 +318,47 @@ def train(  # noqa: C901
             blowup_step = step
         target_step = blowup_step - min_rewind
         log.debug(f'Need to rewind at least to: {target_step}')
-        for i, (step, state) in enumerate(reversed(chkpts)):
-            if step <= target_step:
-                log.debug(f'Found a restart step in memory: {step}')
-                chkpts = chkpts[:-i]
-                raise TrainingCrash(state, chkpts) from e
-        for state_file in sorted(chkpts_dir.glob('state-*.pt'), reverse=True):
-            step = int(state_file.stem.split('-')[1])
-            if step <= target_step:
-                log.debug(f'Found a restart step on disk: {step}')
-                raise TrainingCrash(torch.load(state_file)) from e
+        state = chkpts.rewind(target_step)
+        if state:
+            log.debug(f'Found a restart step in memory: {state["step"]}')
+            raise TrainingCrash(state, chkpts) from e
+        if workdir:
+            chkpt_writer.flush(check=False)
+            for state_file in sorted(chkpts_dir.glob('state-*.pt'), reverse=True):
+                step = int(state_file.stem.split('-')[1])
+                if step <= target_step:
+                    log.debug(f'Found a restart step on disk: {step}')
+                    raise TrainingCrash(torch.load(state_file)) from e
         log.debug('Found no restart step')
         raise TrainingCrash() from e
     finally:
         steps.close()
         if workdir:
             writer.close()
+            table.flush(force=True)
             h5file.close()
+            chkpt_writer.close(check=completed)
+
+
+def prune_configurations(wf, opt, rs, batch_size, threshold):
+    # the contributions are averaged over walkers evaluated in batches, and
+    # the optimizer state is selected along with the parameters
+    contribs = torch.cat([wf.conf_contributions(x) for x in rs.split(batch_size)])
+    contribs = contribs[torch.isfinite(contribs).all(dim=-1)]
+    if not len(contribs):
+        return
+    contribs = contribs.mean(dim=0)
+    keep = contribs >= threshold
+    keep[0] = True
+    if keep.all():
+        return
+    log.info(
+        f'Pruning {(~keep).sum().item()} of {len(keep)} configurations, '
+        f'largest pruned contribution {contribs[~keep].max().item():.2e}'
+    )
+    selected = wf.prune_configurations_(keep.nonzero(as_tuple=True)[0])
+    for param, (dim, idx) in selected.items():
+        param_state = opt.state.get(param, {})
+        for key, value in param_state.items():
+            if torch.is_tensor(value) and value.dim() == param.dim():
+                param_state[key] = value.index_select(dim, idx.to(value.device))
@@ -1,45 +1,389 @@
+import logging
+import os
+import queue
+import threading
+import time
+from copy import deepcopy
+from pathlib import Path
+
 import numpy as np
+import torch
 
 __all__ = ()
 
+log = logging.getLogger(__name__)
+
 
 class H5LogTable:
-    def __init__(self, group):
+    r"""Append rows of arrays to datasets in an HDF5 group.
+
+    Rows are buffered in memory and written in blocks, when :meth:`flush` is
+    called and either enough rows are buffered or enough time has elapsed.
+    Datasets are resized only by the number of written rows, so readers in
+    the SWMR mode never see incomplete rows. Reading with ``table[label]``
+    includes the buffered rows.
+
+    Args:
+        group (:class:`h5py.Group`): HDF5 group storing the datasets
+        chunk_rows (int): number of rows in a HDF5 chunk, chosen to give about
+            1 MiB chunks if not given
+        compression (str): HDF5 compression filter, such as ``'gzip'``
+            or ``'lzf'``
+        float_dtype (str): if given, floating-point arrays are stored with this
+            data type, such as ``'float32'``
+        flush_rows (int): number of buffered rows that triggers a write
+        flush_secs (float): time after which buffered rows are written
+    """
+
+    def __init__(
+        self,
+        group,
+        *,
+        chunk_rows=None,
+        compression=None,
+        float_dtype=None,
+        flush_rows=100,
+        flush_secs=15,
+    ):
         self._group = group
+        self._chunk_rows = chunk_rows
+        self._compression = compression
+        self._float_dtype = float_dtype
+        self._flush_rows = flush_rows
+        self._flush_secs = flush_secs
+        self._buffers = {}
+        self._last_flush = time.time()
 
     def __getitem__(self, label):
-        return self._group[label] if label in self._group else []
+        if label not in self._group and label not in self._buffers:
+            return []
+        return _H5LogColumn(self._group.get(label), self._buffers.get(label, []))
 
     def resize(self, size):
+        self.flush(force=True)
         for ds in self._group.values():
             ds.resize(size, axis=0)
 
+    def flush(self, force=False):
+        """Write buffered rows if due.
+
+        Args:
+            force (bool): write all buffered rows regardless of the budgets
+        """
+        n_rows = max((len(buf) for buf in self._buffers.values()), default=0)
+        if not n_rows:
+            return
+        due = (
+            force
+            or n_rows >= self._flush_rows
+            or time.time() - self._last_flush >= self._flush_secs
+        )
+        if not due:
+            return
+        for label, buf in self._buffers.items():
+            if label not in self._group:
+                self._create_dataset(label, buf[0])
+            ds = self._group[label]
+            n = ds.shape[0]
+            ds.resize(n + len(buf), axis=0)
+            ds[n:, ...] = np.stack(buf)
+        self._buffers = {}
+        self._group.file.flush()
+        self._last_flush = time.time()
+
+    def _create_dataset(self, label, row):
+        if isinstance(row, np.ndarray):
+            shape, dtype = row.shape, row.dtype
+        elif isinstance(row, float):
+            shape, dtype = (), np.dtype(float)
+        else:
+            shape, dtype = (), None
+        if self._float_dtype and dtype is not None and dtype.kind == 'f':
+            dtype = np.dtype(self._float_dtype)
+        row_bytes = np.prod(shape, dtype=int) * (dtype or np.dtype(int)).itemsize
+        chunk_rows = self._chunk_rows or int(np.clip(2 ** 20 // row_bytes, 1, 1024))
+        self._group.create_dataset(
+            label,
+            (0, *shape),
+            maxshape=(None, *shape),
+            dtype=dtype,
+            chunks=(chunk_rows, *shape),
+            compression=self._compression,
+        )
+
     # mimicking Pytables API
     @property
     def row(self):
         class Appender:
             def __setitem__(_, label, row):  # noqa: B902, N805
                 if isinstance(row, np.ndarray):
-                    shape = row.shape
-                elif isinstance(row, (float, int)):
-                    shape = ()
-                if label not in self._group:
-                    if isinstance(row, np.ndarray):
-                        dtype = row.dtype
-                    elif isinstance(row, float):
-                        dtype = float
-                    else:
-                        dtype = None
-                    self._group.create_dataset(
-                        label, (0, *shape), maxshape=(None, *shape), dtype=dtype
-                    )
-                ds = self._group[label]
-                ds.resize(ds.shape[0] + 1, axis=0)
-                ds[-1, ...] = row
+                    row = row.copy()
+                self._buffers.setdefault(label, []).append(row)
 
         return Appender()
 
 
+class _H5LogColumn:
+    def __init__(self, ds, buffer):
+        self._ds = ds
+        self._buffer = buffer
+
+    def __len__(self):
+        return (self._ds.shape[0] if self._ds is not None else 0) + len(self._buffer)
+
+    def __getitem__(self, idx):
+        n_ds = self._ds.shape[0] if self._ds is not None else 0
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            if not 0 <= idx < len(self):
+                raise IndexError(idx)
+            if idx >= n_ds:
+                return np.asarray(self._buffer[idx - n_ds])
+            return self._ds[idx]
+        if not isinstance(idx, slice):
+            raise TypeError(f'Rows are indexed by an integer or a slice, not {idx!r}')
+        start, stop, step = idx.indices(len(self))
+        if step < 0:
+            # HDF5 selections must be increasing, so the rows are read in
+            # increasing order and reversed
+            n = len(range(start, stop, step))
+            return self[start + (n - 1) * step : start + 1 : -step][::-1]
+        # only the selected rows are read from the dataset, the rest are
+        # taken from the buffer
+        rows = []
+        if start < n_ds:
+            rows.append(self._ds[start : min(stop, n_ds) : step])
+        if start < n_ds:
+            start += -(-(n_ds - start) // step) * step
+        if start < stop:
+            rows.append(np.stack(self._buffer[start - n_ds : stop - n_ds : step]))
+        if not rows:
+            if self._ds is not None:
+                return self._ds[0:0]
+            row = np.asarray(self._buffer[0])
+            return np.empty((0, *row.shape), dtype=row.dtype)
+        return np.concatenate(rows) if len(rows) > 1 else rows[0]
+
+
+def cpu_snapshot(x, cache=None, new_cache=None):
+    """Return a copy of a nested state that shares no memory with the original.
+
+    Tensors are copied to CPU. Tensors found in *cache*, keyed by memory
+    location and autograd version counter, are reused instead of copied, and
+    all copied tensors are recorded in *new_cache*.
+    """
+    cache = cache if cache is not None else {}
+    new_cache = new_cache if new_cache is not None else {}
+    if isinstance(x, torch.Tensor):
+        key = (x.data_ptr(), x._version, x.shape, x.stride(), x.dtype, x.device)
+        entry = cache.get(key)
+        copy = entry[1] if entry else x.detach().to('cpu', copy=True)
+        # the source tensor is kept alive so that its memory, and hence
+        # the key, cannot be reused by another tensor
+        new_cache[key] = x, copy
+        return copy
+    if isinstance(x, dict):
+        return type(x)((k, cpu_snapshot(v, cache, new_cache)) for k, v in x.items())
+    if isinstance(x, (list, tuple)):
+        return type(x)(cpu_snapshot(v, cache, new_cache) for v in x)
+    if isinstance(x, (int, float, str, type(None))):
+        return x
+    return deepcopy(x)
+
+
+class CheckpointStore:
+    r"""Ring buffer of training states for rewinding.
+
+    States are stored as detached CPU snapshots, so that they are not affected
+    by further training. Tensors that have not changed since the previous
+    snapshot, as identified by their memory location and autograd version
+    counter, are shared between snapshots rather than copied again.
+
+    Args:
+        chkpts (list): if given, the ``(step, state)`` pairs are stored in this
+            list, which is updated in place
+        interval (int): number of steps between stored states
+        max_size (int): maximum number of stored states
+        max_memory (float): maximum amount of memory (MiB) occupied by the stored
+            states, the oldest states are discarded first
+    """
+
+    def __init__(self, chkpts=None, *, interval=1, max_size=100, max_memory=None):
+        self._chkpts = chkpts if chkpts is not None else []
+        self.interval = interval
+        self.max_size = max_size
+        self.max_memory = max_memory
+        self._cache = {}
+
+    def __len__(self):
+        return len(self._chkpts)
+
+    def __getitem__(self, idx):
+        return self._chkpts[idx]
+
+    def __iter__(self):
+        return iter(self._chkpts)
+
+    def __reversed__(self):
+        return reversed(self._chkpts)
+
+    def memory(self):
+        """Return the total memory (MiB) occupied by the stored states."""
+        tensors = {}
+
+        def collect(x):
+            if isinstance(x, torch.Tensor):
+                tensors[id(x)] = x.numel() * x.element_size()
+            elif isinstance(x, dict):
+                for v in x.values():
+                    collect(v)
+            elif isinstance(x, (list, tuple)):
+                for v in x:
+                    collect(v)
+
+        collect(self._chkpts)
+        return sum(tensors.values()) / 1024 ** 2
+
+    def append(self, step, state):
+        """Store a snapshot of a training state if *step* is due.
+
+        Args:
+            step (int): step index of the state
+            state (dict): training state, may reference live tensors
+        """
+        if step % self.interval:
+            return
+        cache = {}
+        self._chkpts.append((step, cpu_snapshot(state, self._cache, cache)))
+        self._cache = cache
+        while len(self._chkpts) > self.max_size:
+            del self._chkpts[0]
+        if self.max_memory is not None:
+            while len(self._chkpts) > 1 and self.memory() > self.max_memory:
+                del self._chkpts[0]
+
+    def rewind(self, target_step):
+        """Discard states after the latest state at or before a given step.
+
+        Args:
+            target_step (int): the latest acceptable step
+
+        Returns:
+            dict: the state, or :data:`None` if no such state is stored
+        """
+        for i in reversed(range(len(self._chkpts))):
+            step, state = self._chkpts[i]
+            if step <= target_step:
+                del self._chkpts[i + 1 :]
+                self._cache = {}
+                return state
+        return None
+
+
+def atomic_save(obj, path):
+    """Save an object with :func:`torch.save` such that the file is never partial.
+
+    The object is written to a temporary file in the same directory, which is
+    synced and renamed to the target path.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    with tmp_path.open('wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    try:
+        fd = os.open(path.parent, os.O_RDONLY)
+    except OSError:  # directories cannot be opened on some platforms
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class CheckpointWriter:
+    r"""Write training states to disk in a background thread.
+
+    States are snapshotted to CPU when submitted, and written to a temporary
+    file that is synced and atomically renamed, so that a crash never leaves
+    a partially written state file behind.
+
+    Args:
+        directory (str): path to the directory with state files
+        max_queue (int): maximum number of pending states, submitting further
+            states blocks until one is written
+        keep (int): number of most recent state files to keep, all are kept if
+            :data:`None`
+    """
+
+    def __init__(self, directory, *, max_queue=2, keep=None):
+        self.directory = Path(directory)
+        self.keep = keep
+        self._queue = queue.Queue(max_queue)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _check(self, check=True):
+        if self._error:
+            error, self._error = self._error, None
+            if check:
+                raise error
+            log.warning(f'Not raising a failed write of a state: {error!r}')
+
+    def save(self, state, step):
+        """Submit a training state to be written as ``state-<step>.pt``."""
+        self._check()
+        self._queue.put((cpu_snapshot(state), self.directory / f'state-{step:05d}.pt'))
+
+    def flush(self, check=True):
+        """Wait until all submitted states are written.
+
+        Args:
+            check (bool): whether a failed write is raised, otherwise it is
+                only logged, as when handling another exception
+        """
+        self._queue.join()
+        self._check(check)
+
+    def close(self, check=True):
+        """Write all submitted states and stop the background thread.
+
+        Args:
+            check (bool): as in :meth:`flush`
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._check(check)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                state, path = item
+                atomic_save(state, path)
+                log.info(f'Saved state in {path}')
+                if self.keep:
+                    self._prune()
+            except Exception as e:
+                log.error(f'Failed to save state: {e!r}')
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _prune(self):
+        state_files = sorted(
+            self.directory.glob('state-*.pt'), key=lambda p: int(p.stem.split('-')[1])
+        )
+        for state_file in state_files[: -self.keep]:
+            state_file.unlink()
+
+
 class _EnergyOffset:
     value = None
 
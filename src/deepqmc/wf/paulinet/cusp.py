@@ -78,20 +78,27 @@ class CuspCorrection(nn.Module):
             is considered to have a non-zero *s*-type part if
             :math:`s_{\mu I}(0)>\varepsilon`.
 
-    On output, the module returns the mask of corrected electron positions,
-    the indexes of the nuclei that triggered the correction, and the corrected
-    *s*-type part.
+    The polynomials depend only on the orbitals and not on the electron
+    positions. They are obtained with :meth:`fit`, which the caller can reuse
+    as long as the orbitals do not change, and are otherwise fitted on each
+    call.
+
+    On output, the module returns the indexes of the electrons within a cutoff
+    radius, the indexes of the nuclei that triggered the correction, the mask
+    of corrected orbitals, and the corrected *s*-type parts.
 
     Shape:
-        - Input1, :math:`|\mathbf r-\mathbf R_I|^2`: :math:`(*,M)`
+        - Input1, :math:`|\mathbf r-\mathbf R_I|^2`: :math:`(N,M)`
         - Input2, :math:`\mathbf b_{\mu I}`: :math:`(4,M,N_\text{orb})`
         - Input3, :math:`\varphi_\mu(\mathbf R_I)`: :math:`(M,N_\text{orb})`
-        - Output1, corrected?: :math:`(*,N_\text{orb})`
-        - Output2, which nucleus: :math:`(*)`
-        - Output3, corrected :math:`s_{\mu I}(r)`: :math:`(N_\text{corr})`,
-          where :math:`N_\text{corr}` is the number of nonzero elements in
-          the first output (only corrected orbitals are returned in a flattened
-          form)
+        - Output1, which electron: :math:`(N_\text{corr})`, where
+          :math:`N_\text{corr}` is the number of electrons within a cutoff
+          radius
+        - Output2, which nucleus: :math:`(N_\text{corr})`
+        - Output3, corrected?: :math:`(N_\text{corr},N_\text{orb})`
+        - Output4, corrected :math:`s_{\mu I}(r)`:
+          :math:`(N_\text{corr},N_\text{orb})`, defined only for the
+          corrected orbitals
 
     Attributes:
         shifts: orbital shifts :math:`\Delta_{\mu I}` of shape
@@ -105,7 +112,21 @@ class CuspCorrection(nn.Module):
         self.register_buffer('rc', rc)
         self.eps = eps
 
-    def _fit_cusp_poly(self, phi_gto_boundary, mos0):
+    def fit(self, phi_gto_boundary, mos0):
+        r"""Fit the cusp polynomials to the orbitals.
+
+        Args:
+            phi_gto_boundary (:class:`~torch.Tensor`:math:`(4,M,N_\text{orb})`):
+                :math:`\mathbf b_{\mu I}`
+            mos0 (:class:`~torch.Tensor`:math:`(M,N_\text{orb})`):
+                :math:`\varphi_\mu(\mathbf R_I)`
+
+        Returns:
+            tuple of :class:`~torch.Tensor`: the polynomial parameters of
+            shape :math:`(7,M,N_\text{orb})`, zero for orbitals without
+            *s*-type part, and the mask of orbitals with *s*-type part of shape
+            :math:`(M,N_\text{orb})`
+        """
         has_s_part = phi_gto_boundary[0].abs() > self.eps
         charges, rc = (
             x[:, None].expand_as(has_s_part) for x in (self.charges, self.rc)
@@ -128,28 +149,20 @@ class CuspCorrection(nn.Module):
         X3 = d2phi / phi_m_C
         X4 = -charges * (mos0 + phi0 * shifts) / (phi0 - C)
         X5 = torch.log(torch.abs(phi0 - C))
-        return C, sgn, fit_cusp_poly(rc, X1, X2, X3, X4, X5), has_s_part
-
-    def forward(self, rs_2, phi_gto_boundary, mos0):
-        # TODO the indexing here is far from desirable, but I don't have time to
-        # clean it up now
-        C, sgn, alphas, has_s_part = self._fit_cusp_poly(phi_gto_boundary, mos0)
-        rs_2_nearest, center_idx = rs_2.min(dim=-1)
-        maybe_corrected = rs_2_nearest < self.rc[center_idx] ** 2
-        rs_1 = rs_2_nearest[maybe_corrected].sqrt()
-        corrected = maybe_corrected[:, None] & has_s_part[center_idx]
-        params_idx = torch.empty_like(has_s_part, dtype=torch.long)
-        params_idx[has_s_part] = torch.arange(
-            has_s_part.sum(), device=params_idx.device
-        )
-        rs_1_idx = torch.arange(len(rs_1))[:, None].expand(-1, mos0.shape[-1])[
-            corrected[maybe_corrected]
-        ]
-        C, sgn, *alphas = torch.stack([C, sgn, *alphas])[
-            :, params_idx[center_idx][corrected]
-        ]
-        phi_cusped = C + sgn * eval_cusp_poly(rs_1[rs_1_idx], *alphas)
-        return corrected, center_idx, phi_cusped
+        params = torch.stack([C, sgn, *fit_cusp_poly(rc, X1, X2, X3, X4, X5)])
+        params_dense = params.new_zeros(len(params), *has_s_part.shape)
+        params_dense[:, has_s_part] = params
+        return params_dense, has_s_part
+
+    def forward(self, rs_2, phi_gto_boundary, mos0, fit=None):
+        params, has_s_part = fit or self.fit(phi_gto_boundary, mos0)
+        rs_2_nearest, center_idxs = rs_2.min(dim=-1)
+        (elec_idxs,) = (rs_2_nearest < self.rc[center_idxs] ** 2).nonzero(as_tuple=True)
+        center_idxs = center_idxs[elec_idxs]
+        rs_1 = rs_2_nearest[elec_idxs, None].sqrt()
+        C, sgn, *alphas = params[:, center_idxs]
+        phi_cusped = C + sgn * eval_cusp_poly(rs_1, *alphas)
+        return elec_idxs, center_idxs, has_s_part[center_idxs], phi_cusped
 
 
 def fit_cusp_poly(rc, X1, X2, X3, X4, X5):
@@ -5,7 +5,6 @@ import torch
 from scipy.special import factorial2
 from torch import nn
 
-from deepqmc.errors import DeepQMCError
 from deepqmc.torchext import pow_int
 
 __version__ = '0.1.0'
@@ -30,8 +29,12 @@ class GTOShell(nn.Module):
         \xi_{\mathbf l}(\mathbf r)
         :=x^{l_x}y^{l_y}z^{l_z}\sum_m\mathrm c_me^{-\zeta_mr^2}
 
+    If *cart* is false, the shell consists instead of :math:`2l+1` real solid
+    harmonics in the order and normalization of PySCF, obtained as linear
+    combinations of the Cartesian functions.
+
     The instance can be queried with :func:`len` to get the total number of
-    different angular momenta, :math:`N_\mathbf l`
+    basis functions in the shell, :math:`N_\mathbf l`
 
     Args:
         l (int): *l*, total angular momentum
@@ -39,30 +42,41 @@ class GTOShell(nn.Module):
             linear coefficients
         zetas (:class:`~torch.Tensor`:math:`N_\text g`): :math:`\zeta_m`, Gaussian
             exponential coefficients
+        cart (bool): whether the shell is Cartesian or spherical
 
     Shape:
         - Input, :math:`\mathbf r`: :math:`(*,4)`, see [dim4]_
         - Output, :math:`\xi_{\mathbf l}(\mathbf r)`: :math:`(*,N_\mathbf l)`
     """
 
-    def __init__(self, l, coeffs, zetas):
+    def __init__(self, l, coeffs, zetas, cart=True):
         super().__init__()
         self.ls = torch.tensor(get_cartesian_angulars(l))
-        anorms = 1 / np.sqrt(factorial2(2 * self.ls - 1).prod(-1))
+        if cart or l < 2:
+            anorms = 1 / np.sqrt(factorial2(2 * self.ls - 1).prod(-1))
+            self.c2s = None
+        else:
+            from pyscf.gto import cart2sph
+
+            # the Cartesian normalization is folded into the transformation
+            anorms = np.ones(len(self.ls))
+            c2s = np.sqrt(4 * np.pi / factorial2(2 * l + 1)) * cart2sph(l)
+            self.register_buffer('c2s', torch.tensor(c2s).float())
         self.register_buffer('anorms', torch.tensor(anorms).float())
         rnorms = (2 * zetas / np.pi) ** (3 / 4) * (4 * zetas) ** (l / 2)
         self.register_buffer('coeffs', rnorms * coeffs)
         self.register_buffer('zetas', zetas)
 
     def __len__(self):
-        return len(self.ls)
+        return len(self.ls) if self.c2s is None else self.c2s.shape[1]
 
     @property
     def l(self):
         return self.ls[0][0]
 
     def extra_repr(self):
-        return f'l={self.l}, n_primitive={len(self.zetas)}'
+        extra = '' if self.c2s is None else ', cart=False'
+        return f'l={self.l}, n_primitive={len(self.zetas)}{extra}'
 
     def get_cusp_info(self, rc):
         assert self.l == 0
@@ -74,12 +88,50 @@ class GTOShell(nn.Module):
         d2phi_rc_dr2 = 2 * (czes * (2 * self.zetas * rc ** 2 - 1)).sum()
         return torch.stack([phi_0, phi_rc, dphi_rc_dr, d2phi_rc_dr2])
 
+    def cutoff_radius(self, tol):
+        r"""Return a radius beyond which all basis functions are below *tol*.
+
+        The radius is obtained from the envelope
+        :math:`Ar^l\sum_m|c_m|e^{-\zeta_mr^2}`, which bounds the absolute values
+        of all basis functions in the shell, with *A* bounding the angular
+        normalization.
+
+        Args:
+            tol (float): absolute tolerance
+        """
+        l = self.l.item()
+        coeffs, zetas = self.coeffs.abs().tolist(), self.zetas.tolist()
+        ang = (
+            self.anorms.max() if self.c2s is None else self.c2s.abs().sum(dim=0).max()
+        ).item()
+
+        def envelope(r):
+            return (
+                ang
+                * r ** l
+                * sum(c * np.exp(-z * r ** 2) for c, z in zip(coeffs, zetas))
+            )
+
+        # the envelope decreases monotonically beyond its outermost maximum
+        lo = np.sqrt(l / (2 * min(zetas)))
+        if envelope(lo) < tol:
+            return lo
+        hi = lo + 1
+        while envelope(hi) >= tol:
+            lo, hi = hi, 2 * hi
+        for _ in range(50):
+            mid = (lo + hi) / 2
+            lo, hi = (mid, hi) if envelope(mid) >= tol else (lo, mid)
+        return hi
+
     def forward(self, rs):
         rs, rs_2 = rs[..., :3], rs[..., 3]
         angulars = pow_int(rs[:, None, :], self.ls).prod(dim=-1)
         exps = torch.exp(-self.zetas * rs_2[:, None])
         radials = (self.coeffs * exps).sum(dim=-1)
         phis = self.anorms * angulars * radials[:, None]
+        if self.c2s is not None:
+            phis = phis @ self.c2s
         return phis
 
 
@@ -92,24 +144,41 @@ class GTOBasis(nn.Module):
     An instance can be queried with :func:`len` to obtain the total number of
     basis functions, :math:`N_\text{basis}`.
 
+    The basis is evaluated from packed tables built from the shells, in which
+    shells on the same center with the same Gaussian exponents, such as those
+    from general contractions, share the exponentials
+    :math:`e^{-\zeta_mr^2}`. The tables are built on first use and rebuilt
+    after the module is moved, cast, or loaded from a state dictionary. If the
+    shells are modified otherwise, :meth:`pack` must be called.
+
+    If *screening* is given, each shell is evaluated only for electrons within
+    its cutoff radius (:meth:`GTOShell.cutoff_radius`), beyond which all its
+    basis functions are below *screening*, and the remaining basis functions
+    are set to zero. The screened basis functions are scattered into the
+    dense output, so that the contraction with the MO coefficients remains
+    a single matrix multiplication.
+
     Args:
         centers (:class:`~torch.Tensor`:math:`(M,3)`): :math:`\mathbf R_I`, basis
             center coordinates
         shells (list): each item is a 2-tuple (:class:`int`, :class:`GTOShell`)
             encoding a shell placed at a center given by its index
+        screening (float): if given, absolute tolerance for neglecting basis
+            functions far from their centers
 
     Shape:
         - Input, :math:`(\mathbf r-\mathbf R_I)`: :math:`(*,M,4)`, see [dim4]_
         - Output, :math:`\xi_p(\mathbf r)`: :math:`(*,N_\text{basis})`
     """
 
-    def __init__(self, centers, shells):
+    def __init__(self, centers, shells, screening=None):
         super().__init__()
         self.register_buffer('centers', centers)
+        self.screening = screening
         self.center_idxs, shells = zip(*shells)
         self.shells = nn.ModuleList(shells)
         self.s_center_idxs = torch.tensor(
-            [idx for idx, sh in self.items() if sh.l == 0]
+            [idx for idx, sh in self.items() if sh.l == 0], dtype=torch.long
         )
         self.is_s_type = torch.cat(
             [
@@ -117,6 +186,112 @@ class GTOBasis(nn.Module):
                 for sh in self.shells
             ]
         )
+        self._packed = None
+
+    def pack(self):
+        """Build the packed tables used to evaluate the basis."""
+        device = self.centers.device
+        groups, shell_groups = {}, []
+        for idx, sh in self.items():
+            key = (idx, tuple(sh.zetas.tolist()))
+            shell_groups.append(groups.setdefault(key, len(groups)))
+        n_prim = max(len(zetas) for _, zetas in groups)
+        zetas = self.centers.new_zeros(len(groups), n_prim)
+        for (_, group_zetas), i in groups.items():
+            zetas[i, : len(group_zetas)] = torch.tensor(group_zetas)
+        cart_centers = torch.tensor(
+            [idx for idx, sh in self.items() for _ in range(len(sh.ls))],
+            dtype=torch.long,
+        )
+        cart_ls = torch.cat([sh.ls for sh in self.shells])
+        l_max = cart_ls.max().item()
+        coeffs = self.centers.new_zeros(len(self.shells), n_prim)
+        for i, sh in enumerate(self.shells):
+            coeffs[i, : len(sh.coeffs)] = sh.coeffs
+        self._packed = {
+            'group_centers': torch.tensor(
+                [idx for idx, _ in groups], dtype=torch.long, device=device
+            ),
+            'zetas': zetas,
+            'shell_groups': torch.tensor(shell_groups, device=device),
+            'coeffs': coeffs,
+            'cart_shells': torch.tensor(
+                [i for i, sh in enumerate(self.shells) for _ in range(len(sh.ls))],
+                device=device,
+            ),
+            # indexes into the powers of the coordinates flattened from
+            # shape (M, 3, l_max + 1)
+            'cart_pows': (
+                (cart_centers[:, None] * 3 + torch.arange(3)) * (l_max + 1) + cart_ls
+            )
+            .t()
+            .to(device),
+            'anorms': torch.cat([sh.anorms for sh in self.shells]),
+            'l_max': l_max,
+            'sph': self._pack_sph(),
+        }
+        if self.screening is not None:
+            self._packed.update(self._pack_screening())
+
+    def _pack_sph(self):
+        # each spherical function as a combination of at most n_terms
+        # Cartesian functions given by their indexes and coefficients
+        if all(sh.c2s is None for sh in self.shells):
+            return None
+        terms, offset = [], 0
+        for sh in self.shells:
+            if sh.c2s is None:
+                terms.extend([([offset + k], [1.0]) for k in range(len(sh))])
+            else:
+                for col in sh.c2s.t():
+                    (idxs,) = col.nonzero(as_tuple=True)
+                    terms.append(((offset + idxs).tolist(), col[idxs].tolist()))
+            offset += len(sh.ls)
+        n_terms = max(len(idxs) for idxs, _ in terms)
+        idxs = torch.zeros(len(terms), n_terms, dtype=torch.long)
+        coeffs = self.centers.new_zeros(len(terms), n_terms)
+        for i, (term_idxs, term_coeffs) in enumerate(terms):
+            idxs[i, : len(term_idxs)] = torch.tensor(term_idxs)
+            coeffs[i, : len(term_coeffs)] = torch.tensor(term_coeffs)
+        return idxs.to(self.centers.device), coeffs
+
+    def _pack_screening(self):
+        # tables for evaluating shells for a list of (electron, shell) pairs
+        device = self.centers.device
+        n_carts = torch.tensor([len(sh.ls) for sh in self.shells])
+        n_aos = torch.tensor([len(sh) for sh in self.shells])
+        cart_offsets = n_carts.cumsum(dim=0) - n_carts
+        tables = {
+            'shell_centers': torch.tensor(
+                self.center_idxs, dtype=torch.long, device=device
+            ),
+            'cutoffs_2': self.centers.new_tensor(
+                [sh.cutoff_radius(self.screening) ** 2 for sh in self.shells]
+            ),
+            'n_carts': n_carts.to(device),
+            'cart_offsets': cart_offsets.to(device),
+            'n_aos': n_aos.to(device),
+            'ao_offsets': (n_aos.cumsum(dim=0) - n_aos).to(device),
+        }
+        if self._packed['sph'] is not None:
+            idxs, coeffs = self._packed['sph']
+            ao_shells = torch.repeat_interleave(n_aos).to(device)
+            # indexes relative to the first Cartesian function of the shell,
+            # padding terms have zero coefficients
+            tables['sph_local'] = (
+                idxs - cart_offsets.to(device)[ao_shells, None]
+            ).clamp(min=0)
+        return tables
+
+    def _apply(self, fn):
+        super()._apply(fn)
+        self._packed = None
+        return self
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super()._load_from_state_dict(*args, **kwargs)
+        # the shells are loaded only after this module
+        self._packed = None
 
     def __len__(self):
         return sum(map(len, self.shells))
@@ -124,20 +299,30 @@ class GTOBasis(nn.Module):
     def items(self):
         return zip(self.center_idxs, self.shells)
 
+    def center_cutoff_radii(self):
+        """Return the largest cutoff radius of the shells on each center.
+
+        Beyond these radii, all basis functions on the centers are neglected
+        when *screening* is given.
+        """
+        radii = [0.0 for _ in self.centers]
+        for idx, sh in self.items():
+            radii[idx] = max(radii[idx], sh.cutoff_radius(self.screening))
+        return self.centers.new_tensor(radii)
+
     def get_cusp_info(self, rcs):
         return torch.stack(
             [sh.get_cusp_info(rcs[idx]) for idx, sh in self.items() if sh.l == 0]
         )
 
     @classmethod
-    def from_pyscf(cls, mol):
+    def from_pyscf(cls, mol, screening=None):
         """Construct the basis from a PySCF molecule object.
 
         Args:
             mol (:class:`pyscf.gto.mole.Mole`): a molecule
+            screening (float): passed to the constructor
         """
-        if not mol.cart:
-            raise DeepQMCError('GTOBasis supports only Cartesian basis sets')
         centers = torch.tensor(mol.atom_coords()).float()
         shells = []
         for i in range(mol.nbas):
@@ -146,9 +331,90 @@ class GTOBasis(nn.Module):
             zetas = torch.tensor(mol.bas_exp(i)).float()
             coeff_sets = torch.tensor(mol.bas_ctr_coeff(i).T).float()
             for coeffs in coeff_sets:
-                shells.append((i_atom, GTOShell(l, coeffs, zetas)))
-        return cls(centers, shells)
+                shells.append((i_atom, GTOShell(l, coeffs, zetas, cart=mol.cart)))
+        return cls(centers, shells, screening=screening)
 
     def forward(self, diffs):
-        shells = [sh(diffs[:, idx]) for idx, sh in self.items()]
-        return torch.cat(shells, dim=-1)
+        if self._packed is None:
+            self.pack()
+        p = self._packed
+        if self.screening is not None:
+            elec_idxs, ao_idxs, phis = self.forward_screened(diffs)
+            return diffs.new_zeros(len(diffs), len(self)).index_put(
+                (elec_idxs, ao_idxs), phis
+            )
+        rs_2 = diffs[:, p['group_centers'], 3]
+        exps = torch.exp(-p['zetas'] * rs_2[..., None])
+        radials = (p['coeffs'] * exps[:, p['shell_groups']]).sum(dim=-1)
+        pows = self._powers(diffs)
+        idx_x, idx_y, idx_z = p['cart_pows']
+        angulars = pows[:, idx_x] * pows[:, idx_y] * pows[:, idx_z]
+        phis = p['anorms'] * angulars * radials[:, p['cart_shells']]
+        if p['sph'] is not None:
+            idxs, coeffs = p['sph']
+            phis = (phis[:, idxs] * coeffs).sum(dim=-1)
+        return phis
+
+    def forward_screened(self, diffs):
+        r"""Evaluate the basis functions within the shell cutoff radii.
+
+        Args:
+            diffs (:class:`~torch.Tensor`:math:`(N,M,4)`): :math:`(\mathbf
+                r-\mathbf R_I)`, see [dim4]_
+
+        Returns:
+            tuple of three :class:`~torch.Tensor` of the same length: the
+            electron indexes, basis function indexes, and values of the
+            non-negligible basis functions
+        """
+        if self._packed is None:
+            self.pack()
+        p = self._packed
+        rs_2 = diffs[..., 3][:, p['shell_centers']]
+        elec_idxs, shell_idxs = (rs_2 < p['cutoffs_2']).nonzero(as_tuple=True)
+        rs_2 = _take(rs_2.flatten(), elec_idxs * rs_2.shape[1] + shell_idxs)
+        exps = torch.exp(
+            -_take(p['zetas'], _take(p['shell_groups'], shell_idxs)) * rs_2[:, None]
+        )
+        radials = (_take(p['coeffs'], shell_idxs) * exps).sum(dim=-1)
+        pows = self._powers(diffs)
+        pair_idxs, cart_starts, ks = _ragged_range(_take(p['n_carts'], shell_idxs))
+        cart_idxs = _take(_take(p['cart_offsets'], shell_idxs), pair_idxs) + ks
+        cart_elec_idxs = _take(elec_idxs, pair_idxs)
+        pow_idxs = cart_elec_idxs[:, None] * pows.shape[1] + _take(
+            p['cart_pows'].t(), cart_idxs
+        )
+        angulars = _take(pows.flatten(), pow_idxs).prod(dim=-1)
+        phis = _take(p['anorms'], cart_idxs) * angulars * _take(radials, pair_idxs)
+        if p['sph'] is None:
+            return cart_elec_idxs, cart_idxs, phis
+        pair_idxs, _, ks = _ragged_range(_take(p['n_aos'], shell_idxs))
+        ao_idxs = _take(_take(p['ao_offsets'], shell_idxs), pair_idxs) + ks
+        local_idxs = _take(cart_starts, pair_idxs)[:, None] + _take(
+            p['sph_local'], ao_idxs
+        )
+        phis = (_take(phis, local_idxs) * _take(p['sph'][1], ao_idxs)).sum(dim=-1)
+        return _take(elec_idxs, pair_idxs), ao_idxs, phis
+
+    def _powers(self, diffs):
+        # powers of the coordinates flattened from shape (M, 3, l_max + 1)
+        return torch.stack(
+            [diffs[..., :3] ** k for k in range(self._packed['l_max'] + 1)], dim=-1
+        ).flatten(start_dim=1)
+
+
+def _take(xs, idxs):
+    # indexing along the first dimension, index_select is several times
+    # faster than advanced indexing
+    return xs.index_select(0, idxs.flatten()).view(*idxs.shape, *xs.shape[1:])
+
+
+def _ragged_range(counts):
+    # enumerate ranges of the given lengths, return the range index, start in
+    # the concatenation, and position within the range of each element
+    range_idxs = torch.repeat_interleave(
+        torch.arange(len(counts), device=counts.device), counts
+    )
+    starts = counts.cumsum(dim=0) - counts
+    ks = torch.arange(len(range_idxs), device=counts.device) - _take(starts, range_idxs)
+    return range_idxs, starts, ks
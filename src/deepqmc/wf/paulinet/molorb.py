@@ -5,7 +5,7 @@ import torch
 from torch import nn
 
 from deepqmc.physics import pairwise_diffs, pairwise_distance
-from deepqmc.torchext import merge_tensors
+from deepqmc.torchext import is_tracing
 
 from .cusp import CuspCorrection
 
@@ -39,6 +39,13 @@ class MolecularOrbital(nn.Module):
            \varphi_\mu(\mathbf r):=\boldsymbol\Phi_{\boldsymbol\theta}
            (\varphi_\mu(\mathbf r), \{\mathbf e(|\mathbf r-\mathbf R_I|)\})
 
+    The MO coefficients can be made block sparse with :meth:`sparsify_`, after
+    which only the blocks of basis functions on a center that contribute to
+    an MO are contracted. Combined with localized MOs and screened basis
+    functions (see :class:`~deepqmc.wf.paulinet.GTOBasis`), the contraction
+    then scales with the locality of the MOs rather than with the size of the
+    molecule.
+
     If (3) applies, this module also determines the cusp correction cutoff radii
     as :math:`r_\text c:=q/Z`, where *q* is a global factor and *Z* is a nuclear
     charge, and if any two cutoff spheres overlap, reduces the radii accordingly.
@@ -65,6 +72,9 @@ class MolecularOrbital(nn.Module):
         mo_coeff: :class:`torch.nn.Linear` with no bias that represents MO coefficients
             :math:`C_{p\mu}` via its :attr:`weight` variable of shape
             :math:`(N_\text{orb},N_\text{basis})`
+        mo_mask: :data:`None` or a boolean mask of shape
+            :math:`(N_\text{orb},N_\text{basis})` of the MO coefficients
+            retained by :meth:`sparsify_`
     """
 
     def __init__(
@@ -81,6 +91,9 @@ class MolecularOrbital(nn.Module):
         self.n_orbitals = n_orbitals
         self.basis = basis
         self.mo_coeff = nn.Linear(len(basis), n_orbitals, bias=False)
+        self.register_buffer('mo_mask', None)
+        self._mo_blocks = None
+        self._cusp_cache = {}
         if cusp_correction:
             rc = rc_scaling / mol.charges.float()
             dists = pairwise_distance(mol.coords, mol.coords)
@@ -94,15 +107,24 @@ class MolecularOrbital(nn.Module):
         else:
             self.cusp_corr = None
 
-    def init_from_pyscf(self, mf, freeze_mos=False):
+    def init_from_pyscf(self, mf, freeze_mos=False, localize=None):
         """Reinitialize the MO coefficient from a PySCF calculation object.
 
         Args:
             mf (:class:`pyscf.scf.hf.RHF` | :class:`pyscf.mcscf.mc1step.CASSCF`):
                 restricted (multireference) HF calculation
             freeze_mos (bool): whether the MO coefficients should be frozen
+            localize (str): if given, the occupied orbitals are localized
+                without changing the determinants, ``'boys'`` for Foster--Boys
+                or ``'pm'`` for Pipek--Mezey localization. The cusp correction
+                acts on each orbital separately and so changes slightly.
         """
-        mo_coeff = mf.mo_coeff.copy()
+        if localize:
+            from .pyscfext import localize_orbitals
+
+            mo_coeff = localize_orbitals(mf, localize)
+        else:
+            mo_coeff = mf.mo_coeff.copy()
         if mf.mol.cart:
             mo_coeff *= np.sqrt(np.diag(mf.mol.intor('int1e_ovlp_cart')))[:, None]
         self.mo_coeff.weight.detach().copy_(
@@ -111,47 +133,185 @@ class MolecularOrbital(nn.Module):
         if freeze_mos:
             self.mo_coeff.weight.requires_grad_(False)
 
+    def sparsify_(self, threshold):
+        """Restrict the MO coefficients to blocks above a threshold.
+
+        The blocks are formed by the basis functions on each center. A block
+        of an MO is retained if any of its coefficients exceeds *threshold* in
+        absolute value, the other coefficients are set to zero and are no
+        longer used nor optimized.
+
+        Args:
+            threshold (float): absolute threshold for the MO coefficients
+        """
+        weight = self.mo_coeff.weight.detach()
+        ao_centers = self._ao_centers().to(weight.device)
+        block_max = weight.new_zeros(self.n_orbitals, self.n_atoms)
+        for idx in range(self.n_atoms):
+            block_max[:, idx] = weight[:, ao_centers == idx].abs().max(dim=-1).values
+        self.mo_mask = block_max[:, ao_centers] > threshold
+        weight.mul_(self.mo_mask)
+        self._mo_blocks = None
+        return self
+
+    def _ao_centers(self):
+        return torch.tensor(
+            [idx for idx, sh in self.basis.items() for _ in range(len(sh))],
+            dtype=torch.long,
+        )
+
+    def _build_mo_blocks(self):
+        device = self.mo_mask.device
+        ao_centers = self._ao_centers().to(device)
+        cutoffs_2 = (
+            self.basis.center_cutoff_radii() ** 2
+            if self.basis.screening is not None
+            else None
+        )
+        self._mo_blocks = []
+        for idx in range(self.n_atoms):
+            (ao_idxs,) = (ao_centers == idx).nonzero(as_tuple=True)
+            (orb_idxs,) = self.mo_mask[:, ao_idxs].any(dim=-1).nonzero(as_tuple=True)
+            if len(ao_idxs) and len(orb_idxs):
+                cutoff_2 = cutoffs_2[idx].item() if cutoffs_2 is not None else None
+                self._mo_blocks.append((idx, ao_idxs, orb_idxs, cutoff_2))
+
+    def _apply(self, fn):
+        super()._apply(fn)
+        self._mo_blocks = None
+        self._cusp_cache = {}
+        return self
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super()._load_from_state_dict(*args, **kwargs)
+        self._mo_blocks = None
+        self._cusp_cache = {}
+
+    @property
+    def weight(self):
+        weight = self.mo_coeff.weight
+        return weight if self.mo_mask is None else weight * self.mo_mask
+
+    def contract(self, aos, diffs):
+        r"""Contract basis functions with the MO coefficients.
+
+        Args:
+            aos (:class:`~torch.Tensor`:math:`(N,N_\text{basis})`): basis
+                functions
+            diffs (:class:`~torch.Tensor`:math:`(N,M,4)`): :math:`(\mathbf
+                r-\mathbf R_I)`, see [dim4]_
+        """
+        if self.mo_mask is None:
+            return self.mo_coeff(aos)
+        if self._mo_blocks is None:
+            self._build_mo_blocks()
+        n_basis = aos.shape[1]
+        elec_idxs, ao_block_idxs, coeff_block_idxs = [], [], []
+        for idx, ao_idxs, orb_idxs, cutoff_2 in self._mo_blocks:
+            if cutoff_2 is None:
+                elec_idxs_block = torch.arange(len(aos), device=aos.device)
+            else:
+                # only electrons within the cutoff radius of the center
+                (elec_idxs_block,) = (diffs[:, idx, 3] < cutoff_2).nonzero(
+                    as_tuple=True
+                )
+            elec_idxs.append(elec_idxs_block)
+            ao_block_idxs.append(elec_idxs_block[:, None] * n_basis + ao_idxs)
+            coeff_block_idxs.append(orb_idxs[:, None] * n_basis + ao_idxs)
+        # the blocks are gathered and scattered at once, as the backward pass of
+        # each gather and out-of-place scatter involves the full tensor
+        aos_blocks = _take_blocks(aos, ao_block_idxs)
+        coeff_blocks = _take_blocks(self.mo_coeff.weight, coeff_block_idxs)
+        flat_idxs = torch.cat(
+            [
+                (elec_idxs_block[:, None] * self.n_orbitals + orb_idxs).flatten()
+                for elec_idxs_block, (_, _, orb_idxs, _) in zip(
+                    elec_idxs, self._mo_blocks
+                )
+            ]
+        )
+        blocks = torch.cat(
+            [
+                (xs @ coeffs.t()).flatten()
+                for xs, coeffs in zip(aos_blocks, coeff_blocks)
+            ]
+        )
+        # scatter_add is much faster than index_add on CPU
+        mos = aos.new_zeros(len(aos) * self.n_orbitals).scatter_add(
+            0, flat_idxs, blocks
+        )
+        return mos.view(len(aos), self.n_orbitals)
+
     def forward_from_rs(self, rs, coords):
-        diffs_nuc = pairwise_diffs(torch.cat([coords, rs]), coords)
-        return self(diffs_nuc)
+        return self(pairwise_diffs(rs, coords))
 
     def forward(self, diffs):
-        # first n_atoms rows of diffs correspond to electrons on nuclei
-        n_atoms = self.n_atoms
         aos = self.basis(diffs)
-        mos = self.mo_coeff(aos)
-        mos, mos0 = mos[n_atoms:], mos[:n_atoms]
+        mos = self.contract(aos, diffs)
         if self.cusp_corr:
-            dists_2_nuc, aos = diffs[n_atoms:, :, 3], aos[n_atoms:]
-            phi_gto_boundary = torch.stack(  # boundary values for s-type parts of MOs
-                [
-                    self._mo_coeff_s_type_at(idx, self._basis_cusp_info_at(idx))
-                    for idx in range(n_atoms)
-                ],
-                dim=1,
-            )
-            corrected, center_idx, phi_cusped = self.cusp_corr(
-                dists_2_nuc, phi_gto_boundary, mos0
+            phi_gto_boundary, mos0, fit = self._cusp_fit()
+            elec_idxs, center_idxs, corrected, phi_cusped = self.cusp_corr(
+                diffs[:, :, 3], phi_gto_boundary, mos0, fit=fit
             )
-            aos = aos[:, self.basis.is_s_type]
-            phi_gto = torch.empty_like(mos)
-            for idx in range(n_atoms):
-                if not (center_idx == idx).any():
-                    continue
-                phi_gto[center_idx == idx] = self._mo_coeff_s_type_at(
-                    idx, aos[center_idx == idx][:, self.basis.s_center_idxs == idx]
-                )
-            mos = merge_tensors(
-                corrected,
-                mos[corrected] + phi_cusped - phi_gto[corrected],
-                mos[~corrected],
+            # s-type parts of the MOs centered on the nearest nuclei
+            is_s_type = self.basis.is_s_type.to(aos.device)
+            s_center_idxs = self.basis.s_center_idxs.to(aos.device)
+            aos_s = aos[elec_idxs][:, is_s_type]
+            aos_s = aos_s * (s_center_idxs == center_idxs[:, None])
+            phi_gto = aos_s @ self.weight.t()[is_s_type]
+            corrections = torch.where(
+                corrected, phi_cusped - phi_gto, torch.zeros_like(phi_gto)
             )
+            mos = mos.index_put((elec_idxs,), mos[elec_idxs] + corrections)
         return mos
 
-    def _mo_coeff_s_type_at(self, idx, xs):
-        mo_coeff = self.mo_coeff.weight.t()
-        mo_coeff_at = mo_coeff[self.basis.is_s_type][self.basis.s_center_idxs == idx]
-        return xs @ mo_coeff_at
+    def _cusp_fit(self):
+        # the MOs on the nuclei, the boundary values of their s-type parts,
+        # and the cusp polynomials do not depend on the electrons, they are
+        # cached while the parameters are unchanged, unless gradients with
+        # respect to them are required, or the evaluation is traced
+        grad_enabled = torch.is_grad_enabled()
+        weight, shifts = self.mo_coeff.weight, self.cusp_corr.shifts
+        weight_key = _version_key(weight, self.mo_mask)
+        weight_grad = is_tracing() or grad_enabled and weight.requires_grad
+        cache = self._cusp_cache
+        if weight_grad or cache.get('orbitals', (None,))[0] != weight_key:
+            orbitals = self._cusp_orbitals()
+            if not weight_grad:
+                cache['orbitals'] = weight_key, orbitals
+        else:
+            orbitals = cache['orbitals'][1]
+        fit_key = weight_key + _version_key(shifts)
+        fit_grad = weight_grad or grad_enabled and shifts.requires_grad
+        if fit_grad or cache.get('fit', (None,))[0] != fit_key:
+            fit = self.cusp_corr.fit(*orbitals)
+            if not fit_grad:
+                cache['fit'] = fit_key, fit
+        else:
+            fit = cache['fit'][1]
+        return (*orbitals, fit)
+
+    def _cusp_orbitals(self):
+        diffs = pairwise_diffs(self.basis.centers, self.basis.centers)
+        mos0 = self.contract(self.basis(diffs), diffs)
+        is_s_type = self.basis.is_s_type.to(mos0.device)
+        mo_coeff_s = self.weight.t()[is_s_type]
+        phi_gto_boundary = mo_coeff_s.new_zeros(
+            4, self.n_atoms, self.n_orbitals
+        ).index_add(
+            1,
+            self.basis.s_center_idxs.to(mos0.device),
+            self.basis_cusp_info[..., None] * mo_coeff_s,
+        )
+        return phi_gto_boundary, mos0
+
+
+def _version_key(*tensors):
+    return tuple((x.data_ptr(), x._version) if x is not None else None for x in tensors)
+
 
-    def _basis_cusp_info_at(self, idx):
-        return self.basis_cusp_info[:, self.basis.s_center_idxs == idx]
+def _take_blocks(xs, idxs):
+    # gather blocks of a matrix given by indexes into the flattened matrix
+    blocks = xs.flatten().index_select(0, torch.cat([idx.flatten() for idx in idxs]))
+    blocks = blocks.split([idx.numel() for idx in idxs])
+    return [block.view(idx.shape) for block, idx in zip(blocks, idxs)]
@@ -7,7 +7,8 @@ from torch import nn
 from deepqmc import Molecule
 from deepqmc.physics import pairwise_diffs, pairwise_distance
 from deepqmc.plugins import PLUGINS
-from deepqmc.torchext import sloglindet, triu_flat
+from deepqmc.errors import DeepQMCError
+from deepqmc.torchext import is_tracing, sloglindet, triu_flat
 from deepqmc.wf import WaveFunction
 
 from .cusp import CuspCorrection, ElectronicAsymptotic
@@ -34,6 +35,31 @@ def eval_log_slater(xs):
     return xs.contiguous().slogdet()
 
 
+def solve(A, B):
+    # torch.linalg is not available before torch 1.8
+    if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'solve'):
+        return torch.linalg.solve(A, B)
+    return torch.solve(B, A)[0]
+
+
+def expand_spin_dets(xs, idx):
+    # map determinants of distinct spin strings to configurations
+    return xs if idx is None else tuple(x[..., idx] for x in xs)
+
+
+def permutation_sign(perm):
+    # each cycle of even length contributes a factor of -1
+    sign, seen = 1, set()
+    for i in range(len(perm)):
+        j, length = i, 0
+        while j not in seen:
+            seen.add(j)
+            j, length = perm[j], length + 1
+        if length and length % 2 == 0:
+            sign = -sign
+    return sign
+
+
 class PauliNet(WaveFunction):
     r"""Implements the PauliNet ansatz from [HermannNC20]_.
 
@@ -89,6 +115,13 @@ class PauliNet(WaveFunction):
         backflow_transform (str): specifies the :math:`\star` operation:
 
             - ``'mult'`` -- :math:`x\star y:=x\big(1+2\tanh(y)\big)`
+        table_method (bool): whether the determinants of all configurations are
+            obtained from the determinant of the first configuration by low-rank
+            updates, see :meth:`spin_excitations`, requires orbital-type
+            backflow, and replaces the evaluation with :func:`sloglindet`, so
+            that ``use_sloglindet`` has no effect. Walkers at which the
+            determinant of the first configuration is nearly singular are
+            evaluated directly.
         omni_factory (callable): constructor for combined a Jastrow and backflow,
             :math:`(M,N^\uparrow,N^\downarrow,N_\text{orb},N_\text{bf})`
             :math:`\rightarrow(r_{ij},R_{iI})\rightarrow (J,f_{q\mu i})`
@@ -117,6 +150,7 @@ class PauliNet(WaveFunction):
         backflow_type='orbital',
         backflow_channels=1,
         backflow_transform='mult',
+        table_method=False,
         rc_scaling=1.0,
         cusp_alpha=10.0,
         freeze_embed=False,
@@ -125,6 +159,7 @@ class PauliNet(WaveFunction):
     ):
         assert use_sloglindet in {'never', 'training', 'always'}
         assert return_log or use_sloglindet == 'never'
+        assert not table_method or backflow_type == 'orbital'
         super().__init__(mol)
         n_up, n_down = self.n_up, self.n_down
         n_orbitals = n_orbitals or max(n_up, n_down)
@@ -133,6 +168,8 @@ class PauliNet(WaveFunction):
             for _ in range(n_configurations - 1)
         ]
         self.register_buffer('confs', torch.tensor(confs))
+        self._spin_strings = None
+        self._spin_excitations = None
         self.conf_coeff = (
             nn.Linear(n_configurations, 1, bias=False)
             if n_configurations > 1
@@ -158,6 +195,7 @@ class PauliNet(WaveFunction):
             backflow_spec[1] *= 2
         self.backflow_type = backflow_type
         self.backflow_transform = backflow_transform
+        self.table_method = table_method
         if 'paulinet.omni_factory' in PLUGINS:
             log.info('Using a plugin for paulinet.omni_factory')
             omni_factory = PLUGINS['paulinet.omni_factory']
@@ -182,9 +220,76 @@ class PauliNet(WaveFunction):
                 'Setting use_sloglindet to "never" as not implemented for n=0 and n=1.'
             )
         # TODO implement sloglindet for special cases n=0 and n=1
+        elif table_method:
+            if use_sloglindet == 'always':
+                log.warning('Setting use_sloglindet to "never" with table_method.')
+            self.use_sloglindet = 'never'
         else:
             self.use_sloglindet = use_sloglindet
 
+    def spin_strings(self):
+        """Return the distinct spin-up and spin-down occupation strings.
+
+        The strings are recomputed only after the configurations change.
+
+        Returns:
+            two tuples, for spin up and spin down, of the distinct strings and
+            the index of the string of each configuration
+        """
+        key = self.confs.data_ptr(), self.confs._version
+        if self._spin_strings is None or self._spin_strings[0] != key:
+            strings = []
+            for confs in (self.confs[:, : self.n_up], self.confs[:, self.n_up :]):
+                if confs.shape[1] == 0:
+                    strings.append((confs[:1], confs.new_zeros(len(confs))))
+                else:
+                    strings.append(torch.unique(confs, dim=0, return_inverse=True))
+            self._spin_strings = key, strings
+        return self._spin_strings[1]
+
+    def spin_excitations(self):
+        """Return the distinct spin strings as excitations of a reference string.
+
+        The reference is the string of the first configuration. A string that
+        differs from the reference in :math:`k` orbitals is obtained by
+        replacing the orbitals at :math:`k` positions in the reference string
+        by :math:`k` other orbitals, and then permuting the orbitals. Strings
+        with equal :math:`k` are grouped together.
+
+        Returns:
+            two tuples, for spin up and spin down, of a list of groups and the
+            index that orders the concatenated groups as :meth:`spin_strings`.
+            Each group is a tuple of the replaced positions, the replacing
+            orbitals and the signs of the permutations.
+        """
+        key = self.confs.data_ptr(), self.confs._version
+        if self._spin_excitations is None or self._spin_excitations[0] != key:
+            excitations = []
+            for strings, idx in self.spin_strings():
+                ref = strings[idx[0]].tolist()
+                groups = {}
+                for i, string in enumerate(strings.tolist()):
+                    holes = [j for j, mu in enumerate(ref) if mu not in string]
+                    particles = [mu for mu in string if mu not in ref]
+                    excited = list(ref)
+                    for j, mu in zip(holes, particles):
+                        excited[j] = mu
+                    sign = permutation_sign([excited.index(mu) for mu in string])
+                    groups.setdefault(len(holes), []).append(
+                        (i, holes, particles, sign)
+                    )
+                groups = [
+                    [
+                        torch.tensor(x, dtype=torch.long, device=self.confs.device)
+                        for x in zip(*group)
+                    ]
+                    for _, group in sorted(groups.items())
+                ]
+                order = torch.cat([group[0] for group in groups]).argsort()
+                excitations.append(([group[1:] for group in groups], order))
+            self._spin_excitations = key, excitations
+        return self._spin_excitations[1]
+
     def requires_grad_classes_(self, classes, requires_grad):
         for m in self.modules():
             if isinstance(m, classes):
@@ -199,7 +304,9 @@ class PauliNet(WaveFunction):
         return self.requires_grad_classes_(nn.Embedding, requires_grad)
 
     def requires_grad_nets_(self, requires_grad):
-        return self.requires_grad_classes_(nn.Linear, requires_grad)
+        from .omni import Backflow
+
+        return self.requires_grad_classes_((nn.Linear, Backflow), requires_grad)
 
     @classmethod
     def DEFAULTS(cls):
@@ -228,6 +335,9 @@ class PauliNet(WaveFunction):
         freeze_confs=False,
         conf_cutoff=1e-2,
         conf_limit=None,
+        ao_screening=None,
+        localize=None,
+        mo_threshold=None,
         **kwargs,
     ):
         r"""Construct a :class:`PauliNet` instance from a finished PySCF_ calculation.
@@ -245,6 +355,12 @@ class PauliNet(WaveFunction):
                 this threshold are included in the determinant expansion
             conf_limit (int): if given, at maximum the given number of configurations
                 with the largest linear coefficients are used in the ansatz
+            ao_screening (float): if given, basis functions below this absolute
+                tolerance are neglected, see :class:`GTOBasis`
+            localize (str): if given, the occupied molecular orbitals are
+                localized, see :meth:`MolecularOrbital.init_from_pyscf`
+            mo_threshold (float): if given, the MO coefficients are restricted to
+                blocks above this threshold, see :meth:`MolecularOrbital.sparsify_`
             kwargs: all other arguments are passed to the :class:`PauliNet`
                 constructor
 
@@ -289,10 +405,12 @@ class PauliNet(WaveFunction):
             mf.mol.charge,
             mf.mol.spin,
         )
-        basis = GTOBasis.from_pyscf(mf.mol)
+        basis = GTOBasis.from_pyscf(mf.mol, screening=ao_screening)
         wf = cls(mol, basis, **kwargs)
         if init_weights:
-            wf.mo.init_from_pyscf(mf, freeze_mos=freeze_mos)
+            wf.mo.init_from_pyscf(mf, freeze_mos=freeze_mos, localize=localize)
+            if mo_threshold:
+                wf.mo.sparsify_(mo_threshold)
             if confs is not None:
                 wf.confs.detach().copy_(confs)
                 if len(confs) > 1:
@@ -302,7 +420,9 @@ class PauliNet(WaveFunction):
         return wf
 
     @classmethod
-    def from_hf(cls, mol, *, basis='6-311g', cas=None, workdir=None, **kwargs):
+    def from_hf(
+        cls, mol, *, basis='6-311g', cart=True, cas=None, workdir=None, **kwargs
+    ):
         r"""Construct a :class:`PauliNet` instance by running a HF calculation.
 
         This is the top-level interface.
@@ -311,13 +431,15 @@ class PauliNet(WaveFunction):
             mol (:class:`~deepqmc.Molecule`): molecule whose wave function
                 is represented
             basis (str): basis of the internal HF calculation
+            cart (bool): whether the basis uses Cartesian or spherical
+                Gaussian-type orbitals
             cas ((int, int)): tuple of the number of active orbitals and number of
                 active electrons for a complete active space multireference
                 HF calculation
             workdir (str): path where PySCF calculations are cached
             kwargs: all other arguments are passed to :func:`PauliNet.from_pyscf`
         """
-        mf, mc = pyscf_from_mol(mol, basis, cas, workdir)
+        mf, mc = pyscf_from_mol(mol, basis, cas, workdir, cart)
         assert bool(cas) == bool(mc)
         wf = PauliNet.from_pyscf(mc or mf, **kwargs)
         wf.mf = mf
@@ -330,6 +452,119 @@ class PauliNet(WaveFunction):
             return super().pop_charges()
         return mf.pop(verbose=0)[1]
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # PySCF objects hold open streams and cannot be pickled
+        state.pop('mf', None)
+        return state
+
+    def _spin_dets(self, xs, fs):
+        # form dets as [bs, q, p, i, nu]
+        conf_up, conf_down = self.confs[:, : self.n_up], self.confs[:, self.n_up :]
+        idx_up = idx_down = None
+        if fs is None or self.backflow_type == 'orbital':
+            # configurations sharing a spin string share the spin determinant,
+            # which is then evaluated only once, p indexes distinct strings
+            (conf_up, idx_up), (conf_down, idx_down) = self.spin_strings()
+        det_up = xs[:, :, : self.n_up, conf_up].transpose(-3, -2)
+        det_down = xs[:, :, self.n_up :, conf_down].transpose(-3, -2)
+        if fs is not None and self.backflow_type == 'det':
+            n_conf = len(self.confs)
+            fs = fs.unflatten(1, ((None, fs.shape[1] // n_conf), (None, n_conf)))
+            det_up = self._backflow_op(det_up, fs[..., : self.n_up, : self.n_up])
+            det_down = self._backflow_op(det_down, fs[..., self.n_up :, : self.n_down])
+            # with open-shell systems, part of the backflow output is not used
+        return det_up, det_down, idx_up, idx_down
+
+    def _eval_dets(self, det_up, det_down, idx_up, idx_down):
+        # returns the determinants of the configurations as [bs, q, p],
+        # normalized in the log representation
+        if self.return_log:
+            sign_up, det_up = expand_spin_dets(eval_log_slater(det_up), idx_up)
+            sign_down, det_down = expand_spin_dets(eval_log_slater(det_down), idx_down)
+            xs = det_up + det_down
+            xs_shift = xs.flatten(start_dim=1).max(dim=-1).values
+            # the exp-normalize trick, to avoid over/underflow of the exponential
+            xs = sign_up * sign_down * torch.exp(xs - xs_shift[:, None, None])
+            return xs, xs_shift
+        (det_up,) = expand_spin_dets((eval_slater(det_up),), idx_up)
+        (det_down,) = expand_spin_dets((eval_slater(det_down),), idx_down)
+        return det_up * det_down, None
+
+    def _eval_table(self, xs):
+        # xs: orbitals as [bs, q, i, mu], returns the determinants as
+        # _eval_dets. Walkers with a singular reference determinant, or with
+        # ratios so large that the reference is below the numerical precision
+        # relative to the other determinants, are evaluated directly. Their
+        # tables are evaluated with unit reference matrices to keep the
+        # discarded values and their gradients finite.
+        max_ratio = 1 / torch.finfo(xs.dtype).eps
+        with torch.no_grad():
+            singular = xs.new_zeros(len(xs), dtype=torch.bool)
+            for (strings, idx), idxs in zip(self.spin_strings(), self.spin_slices):
+                det_ref = xs[:, :, idxs][..., strings[idx[0]]]
+                singular |= (eval_log_slater(det_ref)[0] == 0).any(dim=-1)
+        while True:
+            dets, ratios = self._eval_table_ratios(xs, singular)
+            with torch.no_grad():
+                unstable = (
+                    ~(torch.isfinite(ratios) & (ratios.abs() <= max_ratio))
+                    .flatten(start_dim=1)
+                    .all(dim=-1)
+                )
+            if not (unstable & ~singular).any():
+                break
+            singular |= unstable
+        if self.return_log:
+            (sign_up, det_up), (sign_down, det_down) = dets
+            dets = det_up + det_down
+            xs_shift = dets.max(dim=-1).values
+            dets = sign_up * sign_down * torch.exp(dets - xs_shift[:, None])
+        else:
+            dets, xs_shift = dets[0] * dets[1], None
+        dets = dets[..., None] * ratios
+        if singular.any():
+            (idx,) = singular.nonzero(as_tuple=True)
+            dets_direct, shift_direct = self._eval_dets(*self._spin_dets(xs[idx], None))
+            dets = dets.index_put((idx,), dets_direct)
+            if xs_shift is not None:
+                xs_shift = xs_shift.index_put((idx,), shift_direct)
+        return dets, xs_shift
+
+    def _eval_table_ratios(self, xs, singular):
+        # returns the reference determinants and the ratios of the determinants
+        # of the configurations, as [bs, q, p], which are the k x k
+        # determinants of the table A_ref^-1 A of the k-fold excitations
+        dets, ratios = [], []
+        for (strings, idx), (groups, order), idxs in zip(
+            self.spin_strings(), self.spin_excitations(), self.spin_slices
+        ):
+            xs_spin = xs[:, :, idxs]
+            det_ref = xs_spin[..., strings[idx[0]]]
+            if singular.any():
+                det_ref = torch.where(
+                    singular[:, None, None, None],
+                    torch.eye(det_ref.shape[-1]).to(det_ref),
+                    det_ref,
+                )
+            dets.append(
+                eval_log_slater(det_ref) if self.return_log else eval_slater(det_ref)
+            )
+            if strings.shape[1] == 0:
+                ratios.append(xs.new_ones(*xs.shape[:2], len(idx)))
+                continue
+            table = solve(det_ref, xs_spin)
+            ratio = torch.cat(
+                [
+                    sign.to(xs)
+                    * eval_slater(table[..., holes[:, :, None], particles[:, None]])
+                    for holes, particles, sign in groups
+                ],
+                dim=-1,
+            )
+            ratios.append(ratio[..., order[idx]])
+        return dets, ratios[0] * ratios[1]
+
     def _backflow_op(self, xs, fs):
         if self.backflow_transform == 'mult':
             fs_mult, fs_add = fs, None
@@ -345,17 +580,17 @@ class PauliNet(WaveFunction):
             xs = xs + 0.1 * envel * torch.tanh(fs_add / 4)
         return xs
 
-    def forward(self, rs):  # noqa: C901
+    def _eval_orbitals(self, rs):
+        # returns the orbitals as [bs, q, i, mu], the backflow as
+        # [bs, q, i, mu/nu] if determinant-type, the Jastrow factor, and the
+        # electron distances
         batch_dim, n_elec = rs.shape[:2]
         assert n_elec == self.confs.shape[1]
         n_atoms = len(self.mol)
-        coords = self.mol.coords
-        diffs_nuc = pairwise_diffs(torch.cat([coords, rs.flatten(end_dim=1)]), coords)
+        diffs_nuc = pairwise_diffs(rs.flatten(end_dim=1), self.mol.coords)
         dists_elec = pairwise_distance(rs, rs)
         if self.omni:
-            dists_nuc = (
-                diffs_nuc[n_atoms:, :, 3].sqrt().view(batch_dim, n_elec, n_atoms)
-            )
+            dists_nuc = diffs_nuc[:, :, 3].sqrt().view(batch_dim, n_elec, n_atoms)
         xs = self.mo(diffs_nuc)
         # get orbitals as [bs, 1, i, mu]
         xs = xs.view(batch_dim, 1, n_elec, -1)
@@ -363,41 +598,139 @@ class PauliNet(WaveFunction):
         J, fs = self.omni(dists_nuc, dists_elec) if self.omni else (None, None)
         if fs is not None and self.backflow_type == 'orbital':
             xs = self._backflow_op(xs, fs)
-        # form dets as [bs, q, p, i, nu]
-        conf_up, conf_down = self.confs[:, : self.n_up], self.confs[:, self.n_up :]
-        det_up = xs[:, :, : self.n_up, conf_up].transpose(-3, -2)
-        det_down = xs[:, :, self.n_up :, conf_down].transpose(-3, -2)
-        if fs is not None and self.backflow_type == 'det':
-            n_conf = len(self.confs)
-            fs = fs.unflatten(1, ((None, fs.shape[1] // n_conf), (None, n_conf)))
-            det_up = self._backflow_op(det_up, fs[..., : self.n_up, : self.n_up])
-            det_down = self._backflow_op(det_down, fs[..., self.n_up :, : self.n_down])
-            # with open-shell systems, part of the backflow output is not used
+        return xs, fs, J, dists_elec
+
+    def conf_contributions(self, rs):
+        r"""Return the relative contributions of the configurations.
+
+        The contribution of a configuration :math:`p` at a walker is
+        :math:`|c_p\det_p|/\max_{p'}|c_{p'}\det_{p'}|`, where the
+        determinants are averaged over the backflow channels.
+
+        Args:
+            rs (:class:`torch.Tensor`): electron coordinates of shape
+                :math:`(B,N,3)`
+
+        Returns:
+            :class:`torch.Tensor` of shape :math:`(B,N_\text{conf})` with
+            values between zero and one
+        """
+        with torch.no_grad():
+            xs, fs, *_ = self._eval_orbitals(rs)
+            if self.table_method:
+                dets, _ = self._eval_table(xs)
+            else:
+                dets, _ = self._eval_dets(*self._spin_dets(xs, fs))
+            dets = dets.abs().mean(dim=1)
+            if isinstance(self.conf_coeff, nn.Linear):
+                dets = self.conf_coeff.weight[0].abs() * dets
+            return dets / dets.max(dim=-1, keepdim=True).values
+
+    def check_prunable(self):
+        """Raise :class:`~deepqmc.errors.DeepQMCError` if pruning is unsupported.
+
+        Configurations can be pruned unless the backflow is determinant-specific
+        and not given by a :class:`~deepqmc.wf.paulinet.omni.Backflow`, whose
+        channels can be selected.
+        """
+        from .omni import Backflow
+
+        if self.backflow_type == 'det' and self.omni:
+            backflow = getattr(self.omni, 'backflow', None)
+            if backflow is not None and not isinstance(backflow, Backflow):
+                raise DeepQMCError(
+                    'Configurations with a determinant-type backflow can be '
+                    f'pruned only with Backflow, not {type(backflow).__name__}'
+                )
+
+    def prune_configurations_(self, keep):
+        """Keep only the given configurations.
+
+        The configurations, their coefficients, and the channels of a
+        determinant-type backflow are selected in place, so that the
+        parameters remain the same objects, and the caller is responsible for
+        updating any state associated with them, such as that of an optimizer.
+
+        Args:
+            keep (:class:`torch.Tensor`): indexes of the kept configurations
+
+        Returns:
+            dict: the resized parameters mapped to the dimension and the
+            indexes along it by which they were selected
+        """
+        self.check_prunable()
+        keep = torch.as_tensor(keep, dtype=torch.long, device=self.confs.device)
+        n_conf = len(self.confs)
+        self.confs = self.confs[keep]
+        self._spin_strings = self._spin_excitations = None
+        selected = {}
+        if isinstance(self.conf_coeff, nn.Linear):
+            selected[self.conf_coeff.weight] = 1, keep
+            self.conf_coeff.in_features = len(keep)
+        if self.backflow_type == 'det' and self.omni:
+            backflow = getattr(self.omni, 'backflow', None)
+            if backflow is not None:
+                # channels are ordered as [q, p], see _spin_dets()
+                n_q = len(backflow.weight1) // n_conf
+                idx = torch.arange(n_q, device=keep.device)[:, None] * n_conf + keep
+                for param in backflow.parameters():
+                    selected[param] = 0, idx.flatten()
+        for param, (dim, idx) in selected.items():
+            param.data = param.data.index_select(dim, idx.to(param.device))
+            param.grad = None
+        self.n_determinants = self.n_determinants // n_conf * len(keep)
+        return selected
+
+    def _load_from_state_dict(self, state_dict, prefix, *args):
+        # shrinks the configurations to those of a stored state, whose values
+        # are then loaded, so that pruned states can be loaded into a model
+        # constructed with all configurations
+        confs = state_dict.get(f'{prefix}confs')
+        if confs is not None and len(confs) > len(self.confs):
+            raise DeepQMCError(
+                f'Stored state has {len(confs)} configurations, '
+                f'the model only {len(self.confs)}'
+            )
+        if confs is not None and len(confs) < len(self.confs):
+            self.prune_configurations_(torch.arange(len(confs)))
+        super()._load_from_state_dict(state_dict, prefix, *args)
+
+    def forward(self, rs):  # noqa: C901
+        xs, fs, J, dists_elec = self._eval_orbitals(rs)
         if self.use_sloglindet == 'always' or (
             self.use_sloglindet == 'training' and not self.sampling
         ):
+            det_up, det_down, idx_up, idx_down = self._spin_dets(xs, fs)
             bf_dim = det_up.shape[-4]
             if isinstance(self.conf_coeff, nn.Linear):
                 conf_coeff = self.conf_coeff.weight[0]
                 conf_coeff = conf_coeff.expand(bf_dim, -1).flatten() / np.sqrt(bf_dim)
             else:
                 conf_coeff = det_up.new_ones(1)
+            idx_up, idx_down = (
+                idx
+                if idx is None
+                else (
+                    torch.arange(bf_dim, device=idx.device)[:, None] * n + idx
+                ).flatten()
+                for idx, n in [
+                    (idx_up, det_up.shape[-3]),
+                    (idx_down, det_down.shape[-3]),
+                ]
+            )
             det_up = det_up.flatten(start_dim=-4, end_dim=-3).contiguous()
             det_down = det_down.flatten(start_dim=-4, end_dim=-3).contiguous()
-            sign, psi = sloglindet(conf_coeff, det_up, det_down)
+            sign, psi = sloglindet(conf_coeff, det_up, det_down, idx_up, idx_down)
             sign = sign.detach()
         else:
-            if self.return_log:
-                sign_up, det_up = eval_log_slater(det_up)
-                sign_down, det_down = eval_log_slater(det_down)
-                xs = det_up + det_down
-                xs_shift = xs.flatten(start_dim=1).max(dim=-1).values
-                # the exp-normalize trick, to avoid over/underflow of the exponential
-                xs = sign_up * sign_down * torch.exp(xs - xs_shift[:, None, None])
+            if self.table_method and not is_tracing():
+                # all configurations share the orbitals, so their determinants
+                # are low-rank updates of the reference determinants. Its
+                # fallbacks for singular walkers depend on the data, so traced
+                # evaluations compute the determinants directly
+                xs, xs_shift = self._eval_table(xs)
             else:
-                det_up = eval_slater(det_up)
-                det_down = eval_slater(det_down)
-                xs = det_up * det_down
+                xs, xs_shift = self._eval_dets(*self._spin_dets(xs, fs))
             psi = self.conf_coeff(xs).squeeze(dim=-1).mean(dim=-1)
             if self.return_log:
                 psi, sign = psi.abs().log() + xs_shift, psi.sign().detach()
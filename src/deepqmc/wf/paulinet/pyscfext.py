@@ -4,7 +4,7 @@ from pathlib import Path
 
 import numpy as np
 import pyscf.lib.chkfile as chk
-from pyscf import dft, gto
+from pyscf import dft, gto, lo
 from pyscf.mcscf import CASSCF
 from pyscf.scf import RHF
 
@@ -28,7 +28,43 @@ def electron_density_of(mf, rs):
     return dft.numint.eval_rho2(mf.mol, aos, mf.mo_coeff, mf.mo_occ, xctype='LDA')
 
 
-def pyscf_from_mol(mol, basis, cas=None, workdir=None):
+def localize_orbitals(mf, method):
+    """Localize occupied orbitals within groups of equal occupation.
+
+    Rotations within a group of orbitals that are all occupied or unoccupied
+    in every configuration leave the determinants unchanged, provided the
+    rotation is proper. For a CASSCF calculation, only the core orbitals are
+    localized.
+
+    Args:
+        mf (:class:`pyscf.scf.hf.RHF` | :class:`pyscf.mcscf.mc1step.CASSCF`):
+            restricted (multireference) HF calculation
+        method (str): ``'boys'`` for Foster--Boys or ``'pm'`` for Pipek--Mezey
+            localization
+
+    Returns:
+        :class:`numpy.ndarray`: the MO coefficients with localized orbitals
+    """
+    localizer = {'boys': lo.Boys, 'pm': lo.PM}[method]
+    mo_coeff = mf.mo_coeff.copy()
+    if hasattr(mf, 'fcisolver'):
+        groups = [np.arange(mf.ncore)]
+    else:
+        occ = mf.mo_occ[mf.mo_occ > 0]
+        groups = np.split(np.arange(len(occ)), np.flatnonzero(np.diff(occ)) + 1)
+    ovlp = mf.mol.intor('int1e_ovlp_cart' if mf.mol.cart else 'int1e_ovlp')
+    for idxs in groups:
+        if len(idxs) < 2:
+            continue
+        orbs = mo_coeff[:, idxs]
+        loc = localizer(mf.mol, orbs).kernel()
+        if np.linalg.det(orbs.T @ ovlp @ loc) < 0:
+            loc[:, -1] *= -1
+        mo_coeff[:, idxs] = loc
+    return mo_coeff
+
+
+def pyscf_from_mol(mol, basis, cas=None, workdir=None, cart=True):
     if workdir:
         workdir = Path(workdir)
         chkfile = workdir / PYSCF_CHKFILE
@@ -36,6 +72,7 @@ def pyscf_from_mol(mol, basis, cas=None, workdir=None):
             mf, mc = pyscf_from_file(chkfile)
             log.info(f'Restored PySCF object from {chkfile}')
             assert mf.mol.basis == basis
+            assert bool(mf.mol.cart) == cart
             assert (
                 not mc and not cas or (mc.ncas == cas[0] and sum(mc.nelecas) == cas[1])
             )
@@ -46,7 +83,7 @@ def pyscf_from_mol(mol, basis, cas=None, workdir=None):
         basis=basis,
         charge=mol.charge,
         spin=mol.spin,
-        cart=True,
+        cart=cart,
     )
     log.info('Running HF...')
     mf = RHF(mol)
@@ -3,7 +3,7 @@ from functools import lru_cache
 import torch
 from torch import nn
 
-from deepqmc.torchext import SSP, get_log_dnn, idx_perm
+from deepqmc.torchext import SSP, get_log_dnn, idx_comb, idx_perm
 
 __version__ = '0.1.0'
 __all__ = ['ElectronicSchNet']
@@ -60,6 +60,17 @@ class SubnetFactory:
         )
 
 
+@lru_cache()
+def idx_pair_sym(n, device=torch.device('cpu')):  # noqa: B008
+    # for ordered pairs of electrons, indexes into unordered pairs of
+    # electrons from idx_comb(), and indexes of the second electrons
+    i, j = idx_comb(n, 2)
+    pair = torch.zeros(n, n, dtype=torch.long)
+    pair[i, j] = pair[j, i] = torch.arange(len(i))
+    i, j = idx_perm(n, 2)
+    return pair[i, j].to(device), j.to(device)
+
+
 class SchNetLayer(nn.Module):
     def __init__(self, factory, n_up):
         super().__init__()
@@ -70,8 +81,8 @@ class SchNetLayer(nn.Module):
     def forward(self, x, Y, edges_elec, edges_nuc):
         *batch_dims, n_elec = edges_nuc.shape[:-2]
         h = self.h(x)
-        i, j = idx_perm(n_elec, 2, x.device)
-        z_elec = (self.w(edges_elec[..., i, j, :]) * h[..., j, :]).sum(dim=-2)
+        pair, j = idx_pair_sym(n_elec, x.device)
+        z_elec = (self.w(edges_elec)[..., pair, :] * h[..., j, :]).sum(dim=-2)
         z_nuc = (self.w(edges_nuc) * Y[..., None, :, :]).sum(dim=-2)
         return self.g(z_elec + z_nuc)
 
@@ -89,6 +100,30 @@ def idx_pair_spin(n_up, n_down, device=torch.device('cpu')):  # noqa: B008
     ]
 
 
+@lru_cache()
+def idx_pair_spin_sym(n_up, n_down, device=torch.device('cpu')):  # noqa: B008
+    # indexes of same-spin and opposite-spin pairs into unordered pairs of
+    # electrons from idx_comb(), and for up-up, up-down, down-up, down-down
+    # ordered pairs, indexes into the former and of the second electrons
+    i, j = idx_comb(n_up + n_down, 2)
+    anti = (i < n_up) & (j >= n_up)
+    pos = torch.empty_like(i)
+    pos[~anti] = torch.arange((~anti).sum().item())
+    pos[anti] = torch.arange(anti.sum().item())
+    pair = torch.zeros(n_up + n_down, n_up + n_down, dtype=torch.long)
+    pair[i, j] = pair[j, i] = pos
+    return (
+        {
+            'same': (~anti).nonzero(as_tuple=True)[0].to(device),
+            'anti': anti.nonzero(as_tuple=True)[0].to(device),
+        },
+        [
+            (lbl, pair[i, j].to(device), j.to(device))
+            for lbl, (i, j) in idx_pair_spin(n_up, n_down)
+        ],
+    )
+
+
 class SchNetSpinLayer(nn.Module):
     def __init__(self, factory, n_up):
         super().__init__()
@@ -102,9 +137,11 @@ class SchNetSpinLayer(nn.Module):
         *batch_dims, n_elec = edges_nuc.shape[:-2]
         n_up, n_down = self.n_up, n_elec - self.n_up
         h = self.h(x)
+        pairs, blocks = idx_pair_spin_sym(n_up, n_down, x.device)
+        ws = {lbl: self.w[lbl](edges_elec[..., idx, :]) for lbl, idx in pairs.items()}
         z_elec_uu, z_elec_ud, z_elec_du, z_elec_dd = (
-            (self.w[l](edges_elec[..., i, j, :]) * h[..., j, :]).sum(dim=-2)
-            for l, (i, j) in idx_pair_spin(n_up, n_down, x.device)
+            (ws[lbl][..., pair, :] * h[..., j, :]).sum(dim=-2)
+            for lbl, pair, j in blocks
         )
         z_elec_same = torch.cat([z_elec_uu, z_elec_dd], dim=-2)
         z_elec_anti = torch.cat([z_elec_ud, z_elec_du], dim=-2)
@@ -177,9 +214,16 @@ class ElectronicSchNet(nn.Module):
         kernel_dim (int): :math:`\dim(\mathbf w)`, dimension of the convolution kernel
         version (int): architecture version, one of ``1`` or ``2``
 
+    The filters :math:`\mathbf w` are evaluated only once for each unordered
+    pair of electrons. The electronic distance features can be passed either
+    for all pairs of electrons, in which case only those with :math:`i<j` are
+    used, or for the unordered pairs only, ordered as in
+    :func:`itertools.combinations`.
+
     Shape:
         - Input1, :math:`\mathbf e(\lvert\mathbf r_i-\mathbf r_j\rvert)`:
-          :math:`(*,N,N,\dim(\mathbf e))`
+          :math:`(*,N,N,\dim(\mathbf e))` or
+          :math:`(*,N(N-1)/2,\dim(\mathbf e))`
         - Input2, :math:`\mathbf e(\lvert\mathbf r_i-\mathbf R_I\rvert)`:
           :math:`(*,N,M,\dim(\mathbf e))`
         - Output: :math:`\mathbf x_i^{(L)}`: :math:`(*,N,\dim(\mathbf X))`
@@ -239,10 +283,15 @@ class ElectronicSchNet(nn.Module):
 
     def forward(self, edges_elec, edges_nuc):
         *batch_dims, n_elec, n_nuclei = edges_nuc.shape[:-1]
-        assert edges_elec.shape[:-1] == (*batch_dims, n_elec, n_elec)
         assert n_elec == len(self.spin_idxs)
-        x = self.X(self.spin_idxs.expand(*batch_dims, -1))
-        Y = self.Y(self.nuclei_idxs.expand(*batch_dims, -1))
+        if len(edges_elec.shape) == len(edges_nuc.shape):
+            assert edges_elec.shape[:-1] == (*batch_dims, n_elec, n_elec)
+            i, j = idx_comb(n_elec, 2, edges_elec.device)
+            edges_elec = edges_elec[..., i, j, :]
+        assert edges_elec.shape[:-1] == (*batch_dims, n_elec * (n_elec - 1) // 2)
+        # embeddings are expanded over the batch dimensions without copies
+        x = self.X.weight[self.spin_idxs].expand(*batch_dims, -1, -1)
+        Y = self.Y.weight[self.nuclei_idxs]
         for (layer, norm) in zip(self.layers, self.layer_norms):
             z = layer(x, Y, edges_elec, edges_nuc)
             if norm:
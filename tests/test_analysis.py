@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+import torch
+from uncertainties import unumpy as unp
+
+from deepqmc.extra.analysis import (
+    BinnedKDEstimator,
+    GaussianKDEstimator,
+    TreeKDEstimator,
+    ewm,
+)
+
+
+def ewm_dense(x, X, Y, alpha, thre=1e-10):
+    deltas = -np.log(alpha) * (x[:, None] - X)
+    mask = (0 <= deltas) & (deltas < -np.log(thre))
+    ws = np.zeros_like(deltas)
+    ws[mask] = np.exp(-deltas[mask])
+    ws = ws / ws.sum(axis=-1)[:, None]
+    mean = (ws * Y).sum(axis=-1)
+    err = np.sqrt((ws ** 2 * (mean[:, None] - Y) ** 2).sum(axis=-1))
+    return mean, err
+
+
+# with an offset, the error is limited by the rounding of the values themselves
+@pytest.mark.parametrize('offset,err_rtol', [(0.0, 1e-14), (-1e3, 1e-12)])
+def test_ewm(offset, err_rtol):
+    rng = np.random.default_rng(0)
+    X = np.arange(5000.0)
+    Y = offset + rng.normal(size=len(X))
+    x = np.sort(rng.uniform(-100, 6000, size=800))
+    with np.errstate(invalid='ignore'):
+        mean, err = ewm_dense(x, X, Y, alpha=0.95)
+    result = ewm(x, X, Y, alpha=0.95, with_err=True)
+    atol = 1e-14 * max(1, abs(offset))
+    assert np.allclose(
+        unp.nominal_values(result), mean, rtol=0, atol=atol, equal_nan=True
+    )
+    assert np.allclose(unp.std_devs(result), err, rtol=err_rtol, atol=0, equal_nan=True)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'ys': True}, {'ys': True, 'normed': True}])
+@pytest.mark.parametrize('n_dim', [1, 2, 3])
+@pytest.mark.parametrize(
+    'kde,rtol_max,rtol_bulk',
+    [(BinnedKDEstimator, 1e-2, 3e-2), (TreeKDEstimator, 1e-3, 5e-3)],
+)
+def test_kde(kde, rtol_max, rtol_bulk, n_dim, kwargs):
+    torch.manual_seed(0)
+    xs = torch.randn(3000, n_dim).double()
+    if kwargs.get('ys'):
+        kwargs = {**kwargs, 'ys': torch.sin(2 * xs).mean(dim=-1) + 2}
+    weights = torch.rand(3000).double()
+    queries = 1.5 * torch.randn(400, n_dim).double()
+    expected = GaussianKDEstimator(xs, weights=weights, bw=0.3, **kwargs)(queries)
+    result = kde(xs, weights=weights, bw=0.3, **kwargs)(queries)
+    dens = GaussianKDEstimator(xs, weights=weights, bw=0.3)(queries)
+    bulk = dens > 0.05 * dens.max()
+    assert not torch.isnan(result).any()
+    assert torch.allclose(result[bulk], expected[bulk], rtol=rtol_bulk, atol=0)
+    if not kwargs.get('normed'):
+        assert torch.allclose(
+            result, expected, rtol=0, atol=rtol_max * expected.abs().max()
+        )
+
+
+@pytest.mark.parametrize('kde', [BinnedKDEstimator, TreeKDEstimator])
+def test_kde_normed_tails(kde):
+    xs = torch.tensor([[0.0, 0.0], [1.0, 1.0]]).double()
+    ys = torch.tensor([1.0, 3.0]).double()
+    queries = torch.tensor([[0.5, 0.5], [1.0, -1.5], [10.0, 10.0]]).double()
+    result = kde(xs, ys, normed=True, bw=0.3)(queries)
+    assert result[0].item() == pytest.approx(2.0, rel=1e-2)
+    assert result[1:].tolist() == [0, 0]
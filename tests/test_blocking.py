@@ -0,0 +1,24 @@
+import numpy as np
+
+from deepqmc.blocking import BlockingAccumulator
+
+
+def test_reblocking():
+    rng = np.random.default_rng(0)
+    xs = np.empty((1024, 8))
+    xs[0] = rng.normal(size=8)
+    for i in range(1, len(xs)):
+        xs[i] = 0.9 * xs[i - 1] + rng.normal(size=8)
+    acc = BlockingAccumulator()
+    for x in xs:
+        acc.update(x)
+    assert np.isclose(acc.mean, xs.mean())
+    series = xs.mean(axis=-1)
+    for size, n, err in acc.reblock():
+        blocks = series.reshape(-1, size).mean(axis=-1)
+        assert n == len(blocks)
+        assert np.isclose(err, blocks.std(ddof=1) / np.sqrt(n))
+    level = acc.optimal_level()
+    assert level is not None
+    assert acc.error == acc.reblock()[level][2]
+    assert acc.error > 3 * acc.reblock()[0][2]
@@ -21,6 +21,11 @@ def test_defaults():
     with runner.isolated_filesystem():
         result = runner.invoke(cli, ['defaults'], catch_exceptions=False)
     assert toml.loads(result.output)
+    # commented hyperparameters must end up in the right table when uncommented
+    params = toml.loads(result.output.replace('#: ', '').replace(' = ...', ' = 0'))
+    assert 'keep_states' in params['train_kwargs']
+    assert 'prune_every' in params['train_kwargs']
+    assert 'target_error' in params['evaluate_kwargs']
 
 
 def test_train():
@@ -62,6 +67,18 @@ def test_evaluate():
     assert 'converged SCF energy' in result.output
 
 
+def test_evaluate_save_every():
+    with runner.isolated_filesystem():
+        with open('param.toml', 'w') as f:
+            evaluate_kwargs = {**PARAM_H2['evaluate_kwargs'], 'save_every': 10}
+            toml.dump({**PARAM_H2, 'evaluate_kwargs': evaluate_kwargs}, f)
+        runner.invoke(
+            cli,
+            ['evaluate', '.', '--no-cuda', '--save-every', '5'],
+            catch_exceptions=False,
+        )
+
+
 def test_validity_check():
     with runner.isolated_filesystem():
         with open('param.toml', 'w'):
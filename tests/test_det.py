@@ -25,3 +25,24 @@ def test_3rd_deriv(xs):
         return (ddys ** 2).sum()
 
     assert torch.autograd.gradcheck(func, xs)
+
+
+def test_sloglindet_shared_dets():
+    torch.manual_seed(0)
+    c = torch.randn(6).double().requires_grad_()
+    A1 = torch.randn(3, 3, 4, 4).double().requires_grad_()
+    A2 = torch.randn(3, 4, 3, 3).double().requires_grad_()
+    idx1 = torch.tensor([0, 0, 1, 2, 1, 2])
+    idx2 = torch.tensor([0, 1, 2, 3, 3, 0])
+    sign, logabs = torchext.sloglindet(c, A1, A2, idx1, idx2)
+    sign_ref, logabs_ref = torchext.sloglindet(
+        c, A1[..., idx1, :, :], A2[..., idx2, :, :]
+    )
+    assert torch.equal(sign, sign_ref)
+    assert torch.allclose(logabs, logabs_ref)
+
+    def func(c, A1, A2):
+        return torchext.sloglindet(c, A1, A2, idx1, idx2)[1]
+
+    assert torch.autograd.gradcheck(func, (c, A1, A2))
+    assert torch.autograd.gradgradcheck(func, (c, A1, A2))
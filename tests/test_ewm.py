@@ -0,0 +1,20 @@
+import numpy as np
+
+from deepqmc.ewm import EWMMonitor
+
+
+def test_monitor_nan_batch():
+    monitor = EWMMonitor()
+    monitor.update(np.full(10, np.nan))
+    assert monitor.step == 0
+    assert np.isnan(monitor.mean_of('mean').n)
+    rng = np.random.default_rng(0)
+    for _ in range(10):
+        monitor.update(rng.normal(size=10))
+    mean = monitor.mean_of('mean')
+    is_outlier, stat = monitor.update(np.full(10, np.nan))
+    assert monitor.step == 11
+    assert not is_outlier.any()
+    assert np.isnan(stat).all()
+    assert monitor.mean_of('mean').n == mean.n
+    assert monitor.mean_of('mean').s == mean.s
@@ -7,6 +7,7 @@ from torch.testing import assert_allclose
 
 from deepqmc.physics import pairwise_diffs
 from deepqmc.wf import PauliNet
+from deepqmc.wf.paulinet.gto import GTOBasis
 from deepqmc.wf.paulinet.pyscfext import eval_ao_normed
 
 
@@ -52,3 +53,67 @@ def test_torch_gto_density(gtowf, grids):
     coords, weights = map(torch.tensor, (grids.coords, grids.weights))
     n_elec = (torch.exp(2 * gtowf(coords[:, None, :])[0]) * weights).sum()
     assert n_elec.item() == approx(1)
+
+
+def test_packed_basis():
+    mol = gto.M(atom='C 0 0 0; H 0 0 2', basis='ano-rcc', cart=True, spin=1)
+    basis = GTOBasis.from_pyscf(mol).double()
+    diffs = pairwise_diffs(torch.randn(10, 3).double(), basis.centers)
+    aos = torch.cat([sh(diffs[:, idx]) for idx, sh in basis.items()], dim=-1)
+    assert_allclose(basis(diffs), aos)
+
+
+def test_spherical_basis():
+    mol = gto.M(atom='O 0 0 0; H 0 0 2', basis='cc-pvtz', cart=False, spin=1)
+    basis = GTOBasis.from_pyscf(mol).double()
+    rs = torch.randn(10, 3).double()
+    diffs = pairwise_diffs(rs, basis.centers)
+    aos = torch.cat([sh(diffs[:, idx]) for idx, sh in basis.items()], dim=-1)
+    assert len(basis) == mol.nao
+    assert_allclose(aos, eval_ao_normed(mol, rs.numpy()))
+    assert_allclose(basis(diffs), aos)
+
+
+@pytest.mark.parametrize('cart', [True, False])
+def test_screened_basis(cart):
+    mol = gto.M(atom='O 0 0 0; H 0 0 6', basis='cc-pvdz', cart=cart, spin=1)
+    basis = GTOBasis.from_pyscf(mol).double()
+    screened = GTOBasis.from_pyscf(mol, screening=1e-6).double()
+    rs = (4 * torch.randn(20, 3)).double().requires_grad_()
+    aos, aos_screened = (b(pairwise_diffs(rs, b.centers)) for b in (basis, screened))
+    assert (aos_screened == 0).any()
+    assert (aos - aos_screened).abs().max() < 1e-6
+    grad, grad_screened = (
+        torch.autograd.grad(xs.sum(), rs)[0] for xs in (aos, aos_screened)
+    )
+    assert_allclose(grad, grad_screened, atol=1e-4, rtol=0)
+
+
+def test_localized_sparse_mos():
+    atom = '; '.join(f'H 0 0 {2.5 * i}' for i in range(12))
+    mol = gto.M(atom=atom, basis='6-31g', unit='bohr', cart=True, verbose=0)
+    mf = scf.RHF(mol).run()
+    kwargs = {'omni_factory': None, 'cusp_correction': False, 'cusp_electrons': False}
+    wf = PauliNet.from_pyscf(mf, **kwargs).double()
+    wf_loc = PauliNet.from_pyscf(mf, localize='boys', **kwargs).double()
+    rs = torch.randn(5, 12, 3).double() + wf.mol.coords.double()
+    assert_allclose(wf_loc(rs)[0], wf(rs)[0])
+    wf_sparse = PauliNet.from_pyscf(
+        mf, localize='boys', mo_threshold=1e-2, ao_screening=1e-8, **kwargs
+    ).double()
+    assert not wf_sparse.mo.mo_mask.all()
+    diffs = pairwise_diffs(rs.flatten(end_dim=1), wf.mol.coords.double())
+    aos = wf_sparse.mo.basis(diffs)
+    assert_allclose(wf_sparse.mo.contract(aos, diffs), aos @ wf_sparse.mo.weight.t())
+
+
+def test_cusp_cache(mf):
+    wf = PauliNet.from_pyscf(mf, omni_factory=None, cusp_electrons=False).double()
+    rs = 0.1 * torch.randn(10, 1, 3).double()
+    with torch.no_grad():
+        log_psis = wf(rs)[0]
+        assert wf.mo._cusp_cache
+        wf.mo.cusp_corr.shifts.add_(0.1)
+        log_psis_shifted = wf(rs)[0]
+    assert not torch.allclose(log_psis, log_psis_shifted)
+    assert_allclose(log_psis_shifted, wf(rs)[0])
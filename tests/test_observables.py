@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+import torch
+
+from deepqmc.observables import (
+    DensityGrid,
+    Observable,
+    PairDistances,
+    RadialDensity,
+    observables_plugin,
+)
+
+
+def test_radial_density():
+    obs = RadialDensity(torch.zeros(1, 3), r_max=2.0, n_bins=2)
+    rs = torch.tensor([[[0.5, 0, 0], [0, 1.5, 0]], [[0, 0, 0.2], [3.0, 0, 0]]])
+    obs.update(rs, torch.tensor([1.0, 3.0]))
+    result = obs.result()
+    shells = 4 / 3 * np.pi * np.diff(result['edges'] ** 3)
+    assert np.allclose(result['density'][0] * shells, [1.0, 0.25])
+
+
+def test_density_grid():
+    obs = DensityGrid([(-1, 1), (-1, 1), (-1, 1)], n_points=2)
+    obs.update(torch.tensor([[[-0.5, -0.5, -0.5], [0.5, 0.5, 0.5]]]))
+    density = obs.result()['density']
+    assert density.shape == (2, 2, 2)
+    assert density[0, 0, 0] == density[1, 1, 1] == 1.0
+    assert density.sum() == 2.0
+
+
+def test_pair_distances():
+    obs = PairDistances(n_up=2, r_max=4.0, n_bins=4)
+    rs = torch.tensor([[[0.0, 0, 0], [1.5, 0, 0], [0, 2.5, 0]]])
+    obs.update(rs)
+    obs.update(rs)
+    result = obs.result()
+    assert result['uu'].tolist() == [0, 1, 0, 0]
+    assert result['dd'].tolist() == [0, 0, 0, 0]
+    assert result['ud'].tolist() == [0, 0, 2, 0]
+    obs2 = PairDistances(n_up=2, r_max=4.0, n_bins=4)
+    obs2.load_state_dict(obs.state_dict())
+    assert np.array_equal(obs2.result()['ud'], result['ud'])
+
+
+def test_observables_plugin():
+    obs = RadialDensity(torch.zeros(1, 3), r_max=2.0, n_bins=2)
+    calls = []
+    plugin = observables_plugin([obs], lambda *args: calls.append(args))
+    rs = torch.tensor([[[0.5, 0, 0], [0, 1.5, 0]], [[0, 0, 0.2], [3.0, 0, 0]]])
+    plugin(None, rs, {'weights': np.array([1.0, 3.0])})
+    assert obs.weight == 4.0
+    assert len(calls) == 1
+
+
+def test_observable_abstract():
+    class Incomplete(Observable):
+        def update(self, rs, weights=None):
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete('incomplete')
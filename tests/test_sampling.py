@@ -0,0 +1,159 @@
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+from deepqmc import Molecule
+from deepqmc.errors import NanError
+from deepqmc.fit import LossEnergy, fit_wf
+from deepqmc.sampling import LangevinSampler, MetropolisSampler, rand_from_mol
+from deepqmc.torchext import is_tracing
+from deepqmc.torchext.utils import _dynamo_is_compiling
+from deepqmc.wf import PauliNet, WaveFunction
+
+
+class GaussianWF(WaveFunction):
+    def __init__(self, mol):
+        super().__init__(mol)
+        self.alpha = torch.nn.Parameter(torch.tensor(1.0))
+        self.nan_walkers = None
+
+    def forward(self, rs):
+        log_psis = -self.alpha * (rs ** 2).sum(dim=(-1, -2))
+        if self.nan_walkers is not None:
+            log_psis = torch.where(
+                self.nan_walkers(rs), log_psis.new_tensor(float('nan')), log_psis
+            )
+        return log_psis, torch.ones_like(log_psis)
+
+
+@pytest.fixture
+def wf():
+    torch.manual_seed(0)
+    return GaussianWF(Molecule.from_name('H2'))
+
+
+def test_quarantine_sampler(wf):
+    sampler = LangevinSampler.from_wf(wf, sample_size=100, max_nan_fraction=0.2)
+    quarantined = []
+    sampler.quarantine = quarantined.append
+    wf.nan_walkers = lambda rs: rs[:, 0, 0] > 2.5
+    sampler.restart()
+    assert quarantined
+    assert torch.isfinite(sampler.log_psis).all()
+    assert (sampler.rs[:, 0, 0] <= 2.5).all()
+    for _ in range(5):
+        sampler.step()
+    assert torch.isfinite(sampler.log_psis).all()
+    wf.nan_walkers = lambda rs: rs[:, 0, 0] > -0.5
+    with pytest.raises(NanError):
+        sampler.restart()
+
+
+def test_quarantine_fit(wf):
+    wf.nan_walkers = lambda rs: rs[:, 0, 0] > 5
+    rs = torch.randn(10, 2, 3)
+    rs[3, 0, 0] = 10
+    log_psis = wf(rs)[0].detach()
+    sampler = [
+        (
+            rs,
+            torch.where(torch.isnan(log_psis), -rs.new_ones(10), log_psis),
+            torch.ones(10),
+        )
+    ]
+    opt = torch.optim.SGD(wf.parameters(), lr=0.01)
+    log_dict = {}
+    with pytest.raises(NanError):
+        next(fit_wf(wf, LossEnergy(), opt, sampler, range(1), log_dict=log_dict))
+    steps = fit_wf(
+        wf,
+        LossEnergy(),
+        opt,
+        sampler,
+        range(1),
+        max_nan_fraction=0.1,
+        log_dict=log_dict,
+    )
+    _, energy = next(steps)
+    assert np.isfinite(energy.n)
+    assert np.isnan(log_dict['E_loc']).tolist() == [i == 3 for i in range(10)]
+
+
+def test_recycling(wf):
+    sampler = LangevinSampler.from_wf(
+        wf, sample_size=100, n_first_certain=0, recycle_age=2, recycle_log_psi=3.0
+    )
+    n_recycled = 0
+    for _ in range(20):
+        *_, info = sampler.step()
+        n_recycled += info['recycled']
+    assert n_recycled > 0
+    assert torch.allclose(info['weights'].sum(), torch.tensor(100.0))
+    assert (sampler._ages <= 2).all()
+
+
+@pytest.mark.parametrize('sampler_cls', [MetropolisSampler, LangevinSampler])
+def test_compiled_sampler(sampler_cls):
+    torch.manual_seed(0)
+    mol = Molecule.from_name('LiH')
+    wf = PauliNet.from_hf(mol, basis='6-31g', cas=(4, 2), conf_limit=2).double()
+    rs = rand_from_mol(mol, 20).double()
+    samplers = [sampler_cls(wf, rs, compiled=compiled) for compiled in [False, True]]
+
+    def assert_steps_equal(n_steps):
+        for step in range(n_steps):
+            samples = []
+            for sampler in samplers:
+                torch.manual_seed(step)
+                samples.append(sampler.step()[:3])
+            for x, y in zip(*samples):
+                assert torch.allclose(x, y, rtol=0, atol=1e-10)
+        for x, y in zip(*(sampler.state.values() for sampler in samplers)):
+            if isinstance(x, torch.Tensor):
+                assert torch.allclose(x.to(y), y, rtol=0, atol=1e-10)
+
+    assert_steps_equal(5)
+    assert len(samplers[1]._compiled_wfs) == 1
+    # parameters are read by the compiled graph at each call
+    with torch.no_grad():
+        for param in wf.parameters():
+            param.add_(1e-2 * torch.randn_like(param))
+    for sampler in samplers:
+        sampler.recompute_psi()
+    assert_steps_equal(2)
+    # a change of structure leads to a new compilation
+    compiled_wf = samplers[1].wf_for(rs)
+    wf.prune_configurations_(torch.tensor([0]))
+    for sampler in samplers:
+        sampler.recompute_psi()
+    assert samplers[1].wf_for(rs) is not compiled_wf
+    assert_steps_equal(2)
+
+
+@pytest.mark.parametrize('compiler', [True, False])
+def test_is_tracing_compiling(monkeypatch, compiler):
+    compiling = SimpleNamespace(value=False)
+
+    def is_compiling():
+        return compiling.value
+
+    monkeypatch.setattr(torch, 'compile', lambda net, **kwargs: net, raising=False)
+    if compiler:
+        monkeypatch.setattr(
+            torch, 'compiler', SimpleNamespace(is_compiling=is_compiling), raising=False
+        )
+    else:
+        # PyTorch 2.0-2.2 has torch.compile without torch.compiler.is_compiling
+        monkeypatch.setattr(torch, 'compiler', SimpleNamespace(), raising=False)
+        dynamo = SimpleNamespace(is_compiling=is_compiling)
+        monkeypatch.setattr(torch, '_dynamo', dynamo, raising=False)
+        monkeypatch.setitem(sys.modules, 'torch._dynamo', dynamo)
+    _dynamo_is_compiling.cache_clear()
+    try:
+        assert not is_tracing()
+        compiling.value = True
+        assert is_tracing()
+    finally:
+        _dynamo_is_compiling.cache_clear()
@@ -1,4 +1,15 @@
+import logging
+import shutil
+
+import h5py
+import pytest
+import toml
+import torch
+
 from deepqmc import Molecule, evaluate, train
+from deepqmc.errors import DeepQMCError
+from deepqmc.io import wf_from_file
+from deepqmc.observables import RadialDensity
 from deepqmc.wf import PauliNet
 
 
@@ -54,3 +65,127 @@ def test_simple_example(tmp_path):
         sample_kwargs={'equilibrate': False, 'block_size': 1},
         sampler_kwargs={'n_decorrelate': 0, 'n_first_certain': 0},
     )
+
+
+def test_evaluate_target_error(caplog):
+    mol = Molecule.from_name('H2')
+    net = PauliNet.from_hf(mol, cas=(2, 2), conf_limit=2)
+    state = {}
+    kwargs = {
+        'sample_size': 10,
+        'sample_kwargs': {'equilibrate': False, 'block_size': 1},
+        'sampler_kwargs': {'n_decorrelate': 0, 'n_first_certain': 0},
+    }
+    result = evaluate(net, state=state, n_steps=100, target_error=10.0, **kwargs)
+    assert state['step'] < 100
+    assert result['energy'].std_dev <= 10.0
+    evaluate(net, state=state, n_steps=state['step'] + 2, **kwargs)
+    assert state['accumulator'].n_blocks == state['step']
+    # without n_steps, sampling continues until the target error is reached
+    result = evaluate(net, state={}, target_error=1.0, **kwargs)
+    assert result['energy'].std_dev <= 1.0
+    with caplog.at_level(logging.WARNING, logger='deepqmc.evaluate'):
+        evaluate(net, state={}, n_steps=2, target_error=1e-6, **kwargs)
+    assert 'before reaching the target error' in caplog.text
+
+
+def test_evaluate_resume(tmp_path):
+    mol = Molecule.from_name('H2')
+    net = PauliNet.from_hf(mol, cas=(2, 2), conf_limit=2)
+    density = RadialDensity(mol.coords, r_max=5.0)
+    kwargs = {
+        'observables': [density],
+        'workdir': tmp_path,
+        'store_steps': True,
+        'sample_size': 5,
+        'sample_kwargs': {'equilibrate': 1, 'block_size': 1},
+        'sampler_kwargs': {'n_decorrelate': 0, 'n_first_certain': 0},
+    }
+    evaluate(net, n_steps=2, **kwargs)
+    evaluate(net, n_steps=5, **kwargs)
+    with h5py.File(tmp_path / 'sample.h5', 'r') as f:
+        assert f['blocks/energy'].shape == (5, 5, 2)
+        assert f['steps/E_loc'].shape == (5, 5)
+        assert f['observables/radial_density/density'].shape == (2, 100)
+    state = torch.load(tmp_path / 'evaluate.pt')
+    assert state['step'] == 5
+    assert state['accumulator'].n_blocks == 5
+    assert state['observables'][0]['weight'] == 25
+    with torch.no_grad():
+        next(net.parameters()).add_(1e-3)
+    # also a finished evaluation of different parameters is not reused
+    with pytest.raises(DeepQMCError):
+        evaluate(net, n_steps=5, **kwargs)
+    with pytest.raises(DeepQMCError):
+        evaluate(net, state={'step': 0, 'sampler': None}, n_steps=5)
+
+
+def test_evaluate_parallel():
+    mol = Molecule.from_name('H2')
+    net = PauliNet.from_hf(mol, cas=(2, 2), conf_limit=2)
+    state = {}
+    result = evaluate(
+        net,
+        state=state,
+        n_steps=4,
+        sample_size=6,
+        n_workers=2,
+        sample_kwargs={'equilibrate': False, 'block_size': 2},
+        sampler_kwargs={'n_decorrelate': 0, 'n_first_certain': 0},
+    )
+    assert 'energy' in result
+    assert state['step'] == 4
+    assert state['accumulator'].n_blocks == 2
+    assert len(state['sampler']) == 2
+
+
+def test_train_prune(tmp_path):
+    params = {
+        'system': 'LiH',
+        'ansatz': 'paulinet',
+        'paulinet_kwargs': {'cas': [4, 2], 'conf_limit': 2},
+    }
+    (tmp_path / 'param.toml').write_text(toml.dumps(params))
+    net, *_ = wf_from_file(tmp_path)
+    assert len(net.confs) == 2
+    chkpts = []
+    train(
+        net,
+        n_steps=2,
+        batch_size=5,
+        epoch_size=1,
+        save_every=2,
+        equilibrate=False,
+        workdir=tmp_path,
+        # everything but the first configuration is pruned
+        prune_every=1,
+        prune_threshold=1.0,
+        chkpts=chkpts,
+        fit_kwargs={'subbatch_size': 5},
+        sampler_kwargs={
+            'sample_size': 5,
+            'n_discard': 0,
+            'n_decorrelate': 0,
+            'n_first_certain': 0,
+        },
+    )
+    assert len(net.confs) == 1
+    opt_state = chkpts[-1][1]['opt']['state']
+    assert all(
+        opt_state[i]['exp_avg'].shape == param.shape
+        for i, param in enumerate(net.parameters())
+        if i in opt_state
+    )
+    shutil.copy(tmp_path / 'chkpts' / 'state-00002.pt', tmp_path / 'state.pt')
+    wf, *_ = wf_from_file(tmp_path)
+    assert len(wf.confs) == 1
+    rs = torch.randn(5, 4, 3)
+    assert torch.allclose(wf(rs)[0], net(rs)[0])
+    result = evaluate(
+        wf,
+        n_steps=1,
+        sample_size=5,
+        sample_kwargs={'equilibrate': False, 'block_size': 1},
+        sampler_kwargs={'n_decorrelate': 0, 'n_first_certain': 0},
+    )
+    assert result['energy'] is not None
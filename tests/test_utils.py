@@ -1,10 +1,96 @@
+import h5py
+import numpy as np
+import pytest
 import torch
 from torch.testing import assert_allclose
 
-from deepqmc.torchext import pow_int
+from deepqmc.torchext import frozen_parameters, pow_int
+from deepqmc.utils import CheckpointStore, CheckpointWriter, H5LogTable
 
 
 def test_pow_int():
     xs = torch.randn(4, 3)
     exps = torch.tensor([(1, 2, 3), (0, 1, 2)])
     assert_allclose(pow_int(xs[:, None, :], exps), xs[:, None, :] ** exps.float())
+
+
+def test_frozen_parameters():
+    net = torch.nn.Sequential(torch.nn.Linear(3, 2), torch.nn.Linear(2, 1))
+    net[1].bias.requires_grad_(False)
+    xs = torch.randn(4, 3, requires_grad=True)
+    with frozen_parameters(net):
+        assert not any(p.requires_grad for p in net.parameters())
+        (grad,) = torch.autograd.grad(net(xs).sum(), xs)
+    assert grad.shape == xs.shape
+    assert [p.requires_grad for p in net.parameters()] == [True, True, True, False]
+
+
+def test_checkpoint_store():
+    net = torch.nn.Linear(3, 2)
+    net.register_buffer('frozen', torch.randn(100))
+    chkpts = []
+    store = CheckpointStore(chkpts, max_size=3)
+    for step in range(5):
+        with torch.no_grad():
+            net.weight.add_(1)
+        store.append(step, {'step': step, 'wf': net.state_dict()})
+    assert [step for step, _ in chkpts] == [2, 3, 4]
+    states = [state['wf'] for _, state in chkpts]
+    assert states[0]['frozen'] is states[-1]['frozen']
+    assert states[0]['weight'] is not states[-1]['weight']
+    assert_allclose(states[-1]['weight'], net.weight.detach())
+    assert_allclose(states[0]['weight'], net.weight.detach() - 2)
+    state = store.rewind(3)
+    assert state['step'] == 3
+    assert len(chkpts) == 2
+    assert store.rewind(1) is None
+
+
+def test_checkpoint_writer(tmp_path):
+    net = torch.nn.Linear(3, 2)
+    writer = CheckpointWriter(tmp_path, keep=2)
+    for step in range(3):
+        writer.save({'step': step, 'wf': net.state_dict()}, step)
+        with torch.no_grad():
+            net.weight.add_(1)
+    writer.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        'state-00001.pt',
+        'state-00002.pt',
+    ]
+    state = torch.load(tmp_path / 'state-00002.pt')
+    assert_allclose(state['wf']['weight'], net.weight.detach() - 1)
+
+
+def test_checkpoint_writer_error(tmp_path):
+    writer = CheckpointWriter(tmp_path / 'missing')
+    writer.save({'step': 0}, 0)
+    writer.flush(check=False)
+    writer.save({'step': 1}, 1)
+    with pytest.raises(OSError):
+        writer.close()
+
+
+def test_h5_log_table(tmp_path):
+    with h5py.File(tmp_path / 'log.h5', 'a', libver='v110') as h5file:
+        table = H5LogTable(h5file, float_dtype='float32', flush_rows=3)
+        for i in range(5):
+            table.row['x'] = np.full(4, i, dtype=float)
+            table.row['i'] = float(i)
+            table.flush()
+        assert h5file['x'].shape == (3, 4)
+        assert h5file['x'].dtype == np.float32
+        assert len(table['x']) == 5
+        assert table['x'][-1].tolist() == [4, 4, 4, 4]
+        assert table['i'][:].tolist() == [0, 1, 2, 3, 4]
+        for idx in [
+            slice(None, None, 2),
+            slice(1, 4),
+            slice(3, None),
+            slice(4, 2),
+            slice(None, None, -2),
+            slice(-1, 0, -1),
+        ]:
+            assert table['i'][idx].tolist() == list(range(5))[idx]
+        table.resize(2)
+        assert h5file['i'][:].tolist() == [0, 1]
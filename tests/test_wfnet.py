@@ -2,14 +2,17 @@ import pytest
 import torch
 from torch import nn
 
-from deepqmc import Molecule
+from deepqmc import Molecule, train
+from deepqmc.errors import DeepQMCError
 from deepqmc.fit import LossEnergy, fit_wf
 from deepqmc.physics import local_energy
 from deepqmc.sampling import LangevinSampler
+from deepqmc.torchext import SSP, get_log_dnn, idx_perm
 from deepqmc.wf import PauliNet
 from deepqmc.wf.paulinet.distbasis import DistanceBasis
 from deepqmc.wf.paulinet.gto import GTOBasis
-from deepqmc.wf.paulinet.schnet import ElectronicSchNet
+from deepqmc.wf.paulinet.omni import Backflow
+from deepqmc.wf.paulinet.schnet import ElectronicSchNet, SchNetLayer, idx_pair_spin
 
 try:
     import pyscf.gto
@@ -129,3 +132,165 @@ def test_loc_ene_backprop(wf, rs):
         for name, param in wf.named_parameters()
     )
     # mo.cusp_corr.shifts is excluded, as gradients occasionally vanish
+
+
+@pytest.mark.parametrize('batch_size', [5, 200])
+def test_backflow_separate_nets(batch_size):
+    torch.manual_seed(0)
+    nets = [get_log_dnn(8, 3, SSP, n_layers=2, last_bias=True) for _ in range(2)]
+    state_dict = {
+        f'nets.{q}.{key}': value
+        for q, net in enumerate(nets)
+        for key, value in net.state_dict().items()
+    }
+    backflow = Backflow(8, 3, 2, n_layers=2)
+    backflow.load_state_dict(state_dict)
+    # covers both the batched and the per-network evaluation
+    xs = torch.randn(batch_size, 4, 8)
+    expected = torch.stack([net(xs) for net in nets], dim=1)
+    assert torch.allclose(backflow(xs), expected, atol=1e-6)
+
+
+def schnet_ordered_pairs(net, edges_elec, edges_nuc):
+    # reference evaluating the filters separately for all ordered pairs
+    *batch_dims, n_elec, n_nuclei = edges_nuc.shape[:-1]
+    x = net.X(net.spin_idxs.expand(*batch_dims, -1))
+    Y = net.Y(net.nuclei_idxs.expand(*batch_dims, -1))
+    for layer in net.layers:
+        h = layer.h(x)
+        if isinstance(layer, SchNetLayer):
+            i, j = idx_perm(n_elec, 2)
+            z_elec = (layer.w(edges_elec[..., i, j, :]) * h[..., j, :]).sum(dim=-2)
+            z_nuc = (layer.w(edges_nuc) * Y[..., None, :, :]).sum(dim=-2)
+            x = x + layer.g(z_elec + z_nuc)
+            continue
+        z_uu, z_ud, z_du, z_dd = (
+            (layer.w[lbl](edges_elec[..., i, j, :]) * h[..., j, :]).sum(dim=-2)
+            for lbl, (i, j) in idx_pair_spin(layer.n_up, n_elec - layer.n_up)
+        )
+        z_nuc = (layer.w['n'](edges_nuc) * Y[..., None, :, :]).sum(dim=-2)
+        x = (
+            x
+            + layer.g['same'](torch.cat([z_uu, z_dd], dim=-2))
+            + layer.g['anti'](torch.cat([z_ud, z_du], dim=-2))
+            + layer.g['n'](z_nuc)
+        )
+    return x
+
+
+@pytest.mark.parametrize('n_up,n_down', [(3, 2), (2, 2), (1, 0)])
+@pytest.mark.parametrize('version', [1, 2])
+def test_schnet_unordered_pairs(version, n_up, n_down):
+    torch.manual_seed(0)
+    n_elec = n_up + n_down
+    net = ElectronicSchNet(
+        n_up, n_down, 2, 16, 4, n_interactions=2, kernel_dim=8, version=version
+    ).double()
+    edges_elec = torch.randn(5, n_elec, n_elec, 4).double()
+    edges_elec = edges_elec + edges_elec.transpose(-2, -3)
+    edges_nuc = torch.randn(5, n_elec, 2, 4).double()
+    # the filters run on matrices of different shapes, for which BLAS may
+    # round differently, so the results agree only to a few ulp
+    assert torch.allclose(
+        net(edges_elec, edges_nuc),
+        schnet_ordered_pairs(net, edges_elec, edges_nuc),
+        rtol=0,
+        atol=1e-14,
+    )
+
+
+@pytest.mark.parametrize('singular_ref', [False, True])
+@pytest.mark.parametrize('sampling', [True, False])
+def test_table_method(sampling, singular_ref):
+    torch.manual_seed(0)
+    mol = Molecule.from_name('LiH')
+    mole = pyscf.gto.M(atom=mol.as_pyscf(), unit='bohr', basis='6-31g', cart=True)
+    wfs = [
+        PauliNet(
+            mol,
+            GTOBasis.from_pyscf(mole),
+            n_configurations=8,
+            n_orbitals=6,
+            table_method=table_method,
+        ).double()
+        for table_method in [False, True]
+    ]
+    if singular_ref:
+        # the first configuration occupies orbitals 0 and 1
+        weight = wfs[0].mo.mo_coeff.weight.detach()
+        weight[1] = weight[0]
+    wfs[1].load_state_dict(wfs[0].state_dict())
+    rs = torch.randn(5, 4, 3).double()
+    results = []
+    for wf in wfs:
+        wf.sample(sampling)
+        Es_loc, log_psis, signs = local_energy(
+            rs, wf, create_graph=True, keep_graph=True
+        )
+        (Es_loc.detach() * log_psis).sum().backward()
+        grads = [p.grad for p in wf.parameters()]
+        results.append((Es_loc, log_psis, signs, grads))
+    (Es_loc, log_psis, signs, grads), expected = results
+    assert torch.equal(signs, expected[2])
+    assert torch.allclose(log_psis, expected[1])
+    assert torch.allclose(Es_loc, expected[0])
+    assert all(
+        torch.allclose(g, g_exp, atol=1e-6 * g_exp.abs().max())
+        for g, g_exp in zip(grads, expected[3])
+    )
+
+
+@pytest.mark.parametrize('sampling', [True, False])
+@pytest.mark.parametrize('backflow_type', ['orbital', 'det'])
+def test_prune_configurations(backflow_type, sampling):
+    torch.manual_seed(0)
+    mol = Molecule.from_name('LiH')
+    mole = pyscf.gto.M(atom=mol.as_pyscf(), unit='bohr', basis='6-31g', cart=True)
+    kwargs = {
+        'n_configurations': 4,
+        'n_orbitals': 6,
+        'backflow_type': backflow_type,
+        'backflow_channels': 2,
+    }
+    wf = PauliNet(mol, GTOBasis.from_pyscf(mole), **kwargs).double()
+    wf.conf_coeff.weight.detach().copy_(torch.tensor([1, 1e-12, 0.5, 1e-12]))
+    wf.sample(sampling)
+    rs = torch.randn(5, 4, 3).double()
+    contribs = wf.conf_contributions(rs)
+    assert contribs.shape == (5, 4)
+    assert contribs[:, [1, 3]].max() < 1e-6
+    log_psis, signs = wf(rs)
+    wf.prune_configurations_(torch.tensor([0, 2]))
+    assert len(wf.confs) == 2
+    assert wf.n_determinants == 4
+    assert wf.conf_coeff.weight.shape == (1, 2)
+    log_psis_pruned, signs_pruned = wf(rs)
+    assert torch.equal(signs_pruned, signs)
+    assert torch.allclose(log_psis_pruned, log_psis, rtol=0, atol=1e-10)
+    # pruned states load into a model constructed with all configurations
+    wf_loaded = PauliNet(mol, GTOBasis.from_pyscf(mole), **kwargs).double()
+    wf_loaded.load_state_dict(wf.state_dict())
+    wf_loaded.sample(sampling)
+    assert torch.equal(wf_loaded.confs, wf.confs)
+    assert torch.equal(wf_loaded(rs)[0], log_psis_pruned)
+    # a model cannot grow to the configurations of a larger state
+    wf_full = PauliNet(mol, GTOBasis.from_pyscf(mole), **kwargs).double()
+    with pytest.raises(DeepQMCError):
+        wf.load_state_dict(wf_full.state_dict())
+
+
+def test_prune_configurations_unsupported():
+    mol = Molecule.from_name('LiH')
+    mole = pyscf.gto.M(atom=mol.as_pyscf(), unit='bohr', basis='6-31g', cart=True)
+    wf = PauliNet(
+        mol,
+        GTOBasis.from_pyscf(mole),
+        n_configurations=4,
+        n_orbitals=6,
+        backflow_type='det',
+    )
+    wf.omni.backflow = nn.Linear(1, 1)
+    with pytest.raises(DeepQMCError):
+        wf.check_prunable()
+    with pytest.raises(DeepQMCError):
+        train(wf, n_steps=1, prune_every=1)